@@ -0,0 +1,173 @@
+#
+# BlockImporter.py - stream blocks from a bootstrap.dat or blkNNNN.dat file
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import os
+import mmap
+import time
+import struct
+from collections import OrderedDict
+
+from LazyBlock import LazyBlock
+
+PROGRESS_SECS = 10
+
+
+class BlockImporter(object):
+	def __init__(self, chaindb, log, max_orphans=1000, pipeline=None):
+		self.chaindb = chaindb
+		self.log = log
+		self.max_orphans = max_orphans
+		self.pipeline = pipeline
+		self.filename = None
+
+		# blocks whose parent has not been imported yet, in file
+		# order: hash -> (file offset, block), and parent -> children
+		self.orphans = OrderedDict()
+		self.orphan_deps = {}
+
+		self.n_blocks = 0
+		self.n_skipped = 0
+		self.n_dropped = 0
+		self.n_bytes = 0
+
+	def resume_pos(self, pos):
+		# everything before this offset is in the database, or will
+		# be once the current batch of blocks is committed
+		for (offset, block) in self.orphans.itervalues():
+			return min(offset, pos)
+		return pos
+
+	def load(self, filename, start=0):
+		f = open(filename, 'rb')
+		try:
+			if os.fstat(f.fileno()).st_size == 0:
+				return 0
+			mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		finally:
+			f.close()
+
+		# the map is not closed: imported blocks may still hold
+		# buffers into it, and it is unmapped with the last of them
+		magic = self.chaindb.netmagic.msg_start
+		self.filename = filename
+		end = len(mm)
+		pos = start
+		t_start = time.time()
+		t_log = t_start
+
+		while pos + 8 <= end:
+			if mm[pos:pos+4] != magic:
+				# skip padding or garbage up to the next block
+				npos = mm.find(magic, pos + 1)
+				if npos < 0:
+					break
+				pos = npos
+				continue
+
+			blksize = struct.unpack("<i", mm[pos+4:pos+8])[0]
+			if blksize < 80 or pos + 8 + blksize > end:
+				self.log.write("Truncated block at offset %d" % (pos,))
+				break
+
+			block = LazyBlock(buffer(mm, pos + 8, blksize))
+			rec = (pos, pos + 8 + blksize)
+			pos += 8 + blksize
+			self.n_bytes += 8 + blksize
+
+			if self.pipeline is None:
+				self.import_block(rec, block)
+			else:
+				# known blocks are skipped without a round trip
+				block.calc_sha256()
+				if self.chaindb.haveblock(block.sha256, False):
+					self.n_skipped += 1
+				else:
+					self.pipeline.submit(block.raw, rec)
+				while self.pipeline.pending() >= 2 * self.pipeline.depth:
+					self.import_next()
+
+			now = time.time()
+			if now - t_log >= PROGRESS_SECS:
+				t_log = now
+				self.progress(pos, end, now - t_start)
+
+		while self.pipeline is not None and self.pipeline.pending():
+			self.import_next()
+
+		self.progress(pos, end, time.time() - t_start)
+		if self.orphans:
+			self.log.write("Import: %d blocks never connected" % (len(self.orphans),))
+		return pos
+
+	def progress(self, pos, end, secs):
+		secs = max(secs, 0.001)
+		self.log.write("Import: height %d, offset %d/%d, %d blocks (%d known), %.1f blocks/s, %.1f MB/s, %d orphans" % (
+			self.chaindb.getheight(), pos, end,
+			self.n_blocks, self.n_skipped, self.n_blocks / secs,
+			self.n_bytes / secs / 1000000.0, len(self.orphans)))
+		if self.pipeline is not None:
+			self.log.write("Import: pipeline %s" % (self.pipeline.stats(),))
+
+	def import_next(self):
+		# the next block back from the pipeline's workers, in order
+		(rec, block) = self.pipeline.get()
+		start = time.time()
+		if block is None:
+			self.log.write("Import: malformed block at offset %d" % (rec[0],))
+			self.chaindb.set_import_pos(self.filename,
+						    self.resume_pos(rec[1]))
+		else:
+			self.import_block(rec, block)
+		self.pipeline.connect_secs += time.time() - start
+
+	def import_block(self, rec, block):
+		# rec: file offsets of the record's start and end
+		self.import_one(rec, block)
+		self.chaindb.set_import_pos(self.filename,
+					    self.resume_pos(rec[1]))
+
+	def import_one(self, rec, block):
+		block.calc_sha256()
+		if self.chaindb.haveblock(block.sha256, False):
+			self.n_skipped += 1
+			return
+
+		if not self.chaindb.have_prevblock(block):
+			if block.sha256 not in self.orphans:
+				self.add_orphan(rec[0], block)
+			return
+
+		self.put(block)
+		if not self.chaindb.haveblock(block.sha256, False):
+			return		# invalid; its children stay queued
+
+		# then any queued blocks this one completes
+		blkhashes = self.orphan_deps.pop(block.sha256, [])
+		while blkhashes:
+			(pos, block) = self.orphans.pop(blkhashes.pop())
+			self.put(block)
+			if self.chaindb.haveblock(block.sha256, False):
+				blkhashes.extend(self.orphan_deps.pop(block.sha256, []))
+
+	def put(self, block):
+		if self.chaindb.putblock(block):
+			self.n_blocks += 1
+
+	def add_orphan(self, pos, block):
+		if len(self.orphans) >= self.max_orphans:
+			# drop the oldest; the file is out of order by more
+			# than the queue covers
+			(blkhash, (opos, oblock)) = self.orphans.popitem(last=False)
+			self.orphan_deps[oblock.hashPrevBlock].remove(blkhash)
+			if not self.orphan_deps[oblock.hashPrevBlock]:
+				del self.orphan_deps[oblock.hashPrevBlock]
+			self.n_dropped += 1
+			self.log.write("Import: dropping orphan block %064x at offset %d" % (blkhash, opos))
+
+		self.orphans[block.sha256] = (pos, block)
+		self.orphan_deps.setdefault(block.hashPrevBlock, []).append(block.sha256)
+
@@ -0,0 +1,113 @@
+#
+# BlockIndex.py - in-memory tree of all known blocks
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+# status flags
+BLK_HAVE_DATA = 1	# block body is in the block files
+BLK_HAVE_HEADER = 2	# header checked, with or without the body
+BLK_PRUNED = 4		# body was stored, connected, then deleted
+BLK_COMPRESSED = 8	# body is stored zlib compressed
+BLK_FAILED = 16		# block, or one before it, failed to connect
+
+
+class BlkNode(object):
+	# one per known block; slots keep a mainnet index compact
+	__slots__ = ('hash', 'prev', 'height', 'work',
+		     'nFile', 'pos', 'size', 'status')
+
+	def __init__(self, hash, prev, height, work):
+		self.hash = hash
+		self.prev = prev	# BlkNode, or None for genesis
+		self.height = height
+		self.work = work	# cumulative chain work
+		self.nFile = -1
+		self.pos = 0
+		self.size = 0
+		self.status = 0
+
+	def __repr__(self):
+		return "BlkNode(%064x, height %d, status %d)" % (self.hash, self.height, self.status)
+
+
+class BlockIndex(object):
+	def __init__(self):
+		self.nodes = {}
+
+	def __len__(self):
+		return len(self.nodes)
+
+	def __contains__(self, blkhash):
+		return blkhash in self.nodes
+
+	def get(self, blkhash):
+		return self.nodes.get(blkhash)
+
+	def add(self, blkhash, prevhash, height, work):
+		node = self.nodes.get(blkhash)
+		if node is None:
+			node = BlkNode(blkhash, self.nodes.get(prevhash),
+				       height, work)
+			self.nodes[blkhash] = node
+		return node
+
+	def link(self, prevhashes):
+		# attach prev pointers after a bulk load in arbitrary order
+		for blkhash, prevhash in prevhashes.iteritems():
+			self.nodes[blkhash].prev = self.nodes.get(prevhash)
+
+	def fail(self, node):
+		node.status |= BLK_FAILED
+		self.fail_descendants(node.height)
+
+	def fail_descendants(self, height=0):
+		# every block built on a failed one fails too.  parents are
+		# visited before children, so it passes down the tree.
+		l = [node for node in self.nodes.itervalues()
+		     if node.height > height]
+		l.sort(key=lambda node: node.height)
+		for node in l:
+			if node.prev is not None and (node.prev.status & BLK_FAILED):
+				node.status |= BLK_FAILED
+
+	def ancestor(self, node, height):
+		if height < 0 or height > node.height:
+			return None
+		while node is not None and node.height > height:
+			node = node.prev
+		return node
+
+	def locator(self, node):
+		# hashes back from node: the last 10 one by one, then at
+		# doubling distances, always ending with genesis
+		heights = set()
+		step = 1
+		height = node.height
+		while height > 0:
+			heights.add(height)
+			if len(heights) >= 10:
+				step *= 2
+			height -= step
+		heights.add(0)
+
+		l = []
+		while node is not None:
+			if node.height in heights:
+				l.append(node.hash)
+			node = node.prev
+		return l
+
+	def fork_point(self, a, b):
+		if a.height > b.height:
+			a = self.ancestor(a, b.height)
+		elif b.height > a.height:
+			b = self.ancestor(b, a.height)
+		while a is not b:
+			if a is None or b is None:
+				return None
+			a = a.prev
+			b = b.prev
+		return a
+
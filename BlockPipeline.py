@@ -0,0 +1,144 @@
+#
+# BlockPipeline.py - parse and check blocks in worker processes, hand them
+# back in submission order
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import time
+import Queue
+import multiprocessing
+from collections import deque
+
+from LazyBlock import LazyBlock
+
+
+def check_worker(jobs, results):
+	while True:
+		job = jobs.get()
+		if job is None:
+			return
+
+		(seq, raw) = job
+		start = time.time()
+		try:
+			block = LazyBlock(raw)
+			block.decode_vtx()
+			block.calc_sha256()
+			ok = block.is_valid()
+			r = (block.sha256, [tx.sha256 for tx in block.vtx], ok)
+		except Exception:
+			r = None	# malformed
+		results.put((seq, r, time.time() - start))
+
+
+class BlockPipeline(object):
+	# stage 1, in 'nproc' workers: deserialize, hash, and run the
+	# context-free checks (proof of work, merkle root, tx structure).
+	# stage 2, the caller: take blocks back in order with get(), then
+	# store and connect them, adding the time taken to connect_secs.
+	def __init__(self, nproc, depth=None):
+		self.depth = depth or nproc * 4
+		self.jobs = multiprocessing.Queue(self.depth)
+		self.results = multiprocessing.Queue()
+		self.procs = []
+		for i in xrange(nproc):
+			p = multiprocessing.Process(target=check_worker,
+						    args=(self.jobs, self.results))
+			p.daemon = True
+			p.start()
+			self.procs.append(p)
+
+		self.seq = 0		# next to submit
+		self.next_seq = 0	# next to hand back
+		self.backlog = deque()	# submitted, not yet sent to a worker
+		self.inflight = {}	# seq -> (raw, tag), at a worker
+		self.done = {}		# seq -> (tag, block), waiting for order
+
+		self.n_submitted = 0
+		self.n_checked = 0
+		self.n_invalid = 0
+		self.check_secs = 0.0	# worker time
+		self.wait_secs = 0.0	# caller blocked on workers
+		self.connect_secs = 0.0	# caller time, reported by the caller
+
+	def pending(self):
+		return self.seq - self.next_seq
+
+	def submit(self, raw, tag=None):
+		self.backlog.append((self.seq, raw, tag))
+		self.seq += 1
+		self.n_submitted += 1
+		self.pump()
+
+	def pump(self):
+		while self.backlog and len(self.inflight) < self.depth:
+			(seq, raw, tag) = self.backlog[0]
+			try:
+				self.jobs.put_nowait((seq, str(raw)))
+			except Queue.Full:
+				break
+			self.backlog.popleft()
+			self.inflight[seq] = (raw, tag)
+
+	def receive(self, wait):
+		start = time.time()
+		try:
+			(seq, r, secs) = self.results.get(wait)
+		except Queue.Empty:
+			return False
+		self.wait_secs += time.time() - start
+		self.check_secs += secs
+		self.n_checked += 1
+
+		(raw, tag) = self.inflight.pop(seq)
+		block = None
+		if r is not None:
+			block = LazyBlock(raw, r[0])
+			block.txhashes = r[1]
+			block.checked = r[2]
+			if not r[2]:
+				self.n_invalid += 1
+		else:
+			self.n_invalid += 1
+		self.done[seq] = (tag, block)
+		return True
+
+	def get(self, wait=True):
+		# next (tag, block) in submission order; block is None if
+		# it could not be parsed.  returns None when nothing is
+		# pending, or without wait, when the next is not ready.
+		while self.next_seq not in self.done:
+			if self.pending() == 0:
+				return None
+			self.pump()
+			if not self.receive(wait):
+				return None
+
+		r = self.done.pop(self.next_seq)
+		self.next_seq += 1
+		self.pump()
+		return r
+
+	def stats(self):
+		return {
+			'workers' : len(self.procs),
+			'submitted' : self.n_submitted,
+			'checked' : self.n_checked,
+			'invalid' : self.n_invalid,
+			'backlog' : len(self.backlog),
+			'in_workers' : len(self.inflight),
+			'awaiting_order' : len(self.done),
+			'check_secs' : round(self.check_secs, 3),
+			'wait_secs' : round(self.wait_secs, 3),
+			'connect_secs' : round(self.connect_secs, 3),
+		}
+
+	def close(self):
+		for p in self.procs:
+			self.jobs.put(None)
+		for p in self.procs:
+			p.join()
+		self.procs = []
+
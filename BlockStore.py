@@ -0,0 +1,129 @@
+#
+# BlockStore.py - block data in numbered, preallocated segment files
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import io
+import os
+import mmap
+
+ZERO_CHUNK = '\0' * (1024 * 1024)
+
+
+class BlockStore(object):
+	def __init__(self, datadir, nFile=0, pos=0,
+		     max_size=128 * 1024 * 1024, prealloc=16 * 1024 * 1024):
+		self.datadir = datadir
+		self.max_size = max_size
+		self.prealloc = prealloc
+		self.maps = {}
+
+		# write cursor: current segment and end of its used data.
+		# the segment may extend past pos with preallocated zeros.
+		self.nFile = nFile
+		self.pos = pos
+		self.wf = None
+		self.allocated = 0
+
+	def filename(self, nFile):
+		return "%s/blk%05d.dat" % (self.datadir, nFile)
+
+	def open_writer(self):
+		fn = self.filename(self.nFile)
+		if not os.path.exists(fn):
+			open(fn, 'ab').close()
+		self.wf = io.FileIO(fn, 'r+b')
+		self.allocated = os.fstat(self.wf.fileno()).st_size
+
+	def finish_file(self):
+		# release the unused, preallocated tail
+		self.wf.truncate(self.pos)
+		os.fsync(self.wf.fileno())
+		self.wf.close()
+		self.wf = None
+
+	def sync(self):
+		# earlier segments were synced as they were finished
+		if self.wf is not None:
+			os.fsync(self.wf.fileno())
+
+	def allocate(self, end):
+		# grow the segment in whole prealloc chunks, so the
+		# filesystem can lay it out contiguously
+		target = ((end + self.prealloc - 1) // self.prealloc) * self.prealloc
+		target = min(target, max(self.max_size, end))
+
+		self.wf.seek(self.allocated)
+		while self.allocated < target:
+			n = min(target - self.allocated, len(ZERO_CHUNK))
+			self.wf.write(ZERO_CHUNK[:n])
+			self.allocated += n
+
+	def write(self, data):
+		if self.wf is None:
+			self.open_writer()
+
+		# start a new segment rather than grow past max_size
+		if self.pos > 0 and self.pos + len(data) > self.max_size:
+			self.finish_file()
+			self.nFile += 1
+			self.pos = 0
+			self.open_writer()
+
+		if self.pos + len(data) > self.allocated:
+			self.allocate(self.pos + len(data))
+
+		self.wf.seek(self.pos)
+		self.wf.write(data)
+
+		r = (self.nFile, self.pos)
+		self.pos += len(data)
+
+		return r
+
+	def map(self, nFile, end):
+		mm = self.maps.get(nFile)
+		if mm is not None and len(mm) >= end:
+			return mm
+
+		# first use, or the segment has grown since it was mapped.
+		# a replaced map is not closed: outstanding views keep it
+		# alive, and it is unmapped once the last one goes away.
+		f = open(self.filename(nFile), 'rb')
+		try:
+			mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		finally:
+			f.close()
+		self.maps[nFile] = mm
+		if len(mm) < end:
+			return None
+		return mm
+
+	def view(self, nFile, pos, size):
+		# zero-copy, read-only slice of a segment.  readers share
+		# no file position, so they never wait on each other.
+		try:
+			mm = self.map(nFile, pos + size)
+		except (EnvironmentError, ValueError):
+			return None
+		if mm is None:
+			return None
+		return buffer(mm, pos, size)
+
+	def remove(self, nFile):
+		# delete a finished segment.  existing views of it stay
+		# valid until released; the map is just no longer reused.
+		self.maps.pop(nFile, None)
+		try:
+			os.unlink(self.filename(nFile))
+		except OSError:
+			pass
+
+	def close(self):
+		if self.wf is not None:
+			self.wf.close()
+			self.wf = None
+		self.maps = {}
+
@@ -0,0 +1,34 @@
+#
+# BloomFilter.py - in-memory filter answering "definitely absent" for hashes
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+
+class BloomFilter(object):
+	# keys are uint256 hashes, already uniformly distributed, so the
+	# bit positions are taken from 32-bit slices of the key itself
+	def __init__(self, nbytes, nhashes=6):
+		self.nbits = nbytes * 8
+		self.nhashes = min(nhashes, 8)
+		self.bits = bytearray(nbytes)
+		self.n_added = 0
+		self.n_absent = 0	# lookups answered without the database
+
+	def positions(self, h):
+		for i in xrange(self.nhashes):
+			yield ((h >> (32 * i)) & 0xffffffffL) % self.nbits
+
+	def add(self, h):
+		for bit in self.positions(h):
+			self.bits[bit >> 3] |= 1 << (bit & 7)
+		self.n_added += 1
+
+	def contains(self, h):
+		for bit in self.positions(h):
+			if not (self.bits[bit >> 3] & (1 << (bit & 7))):
+				self.n_absent += 1
+				return False
+		return True
+
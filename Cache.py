@@ -1,4 +1,3 @@
-
 #
 # Cache.py
 #
@@ -6,28 +5,71 @@
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 #
 
+from collections import OrderedDict
+
 
 class Cache(object):
-	def __init__(self, max=1000):
-		self.d = {}
-		self.l = []
+	# least-recently-used cache, bounded by entry count and, when
+	# sizefn is given, by the total of sizefn(v) over all values
+	def __init__(self, max=1000, max_bytes=0, sizefn=None):
+		self.d = OrderedDict()	# k -> (v, size), oldest first
 		self.max = max
+		self.max_bytes = max_bytes
+		self.sizefn = sizefn
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def _size(self, v):
+		if self.sizefn is None:
+			return 0
+		return self.sizefn(v)
+
+	def _evict(self):
+		(k, (v, size)) = self.d.popitem(last=False)
+		self.bytes -= size
+		self.evictions += 1
 
 	def put(self, k, v):
-		self.d[k] = v
-		self.l.append(k)
+		# the size is taken once: a value may change size while
+		# cached, and is accounted for as it was when added
+		if k in self.d:
+			self.bytes -= self.d.pop(k)[1]
+		size = self._size(v)
+		self.d[k] = (v, size)
+		self.bytes += size
 
-		while (len(self.l) > self.max):
-			kdel = self.l[0]
-			del self.l[0]
-			del self.d[kdel]
+		while len(self.d) > self.max:
+			self._evict()
+		if self.max_bytes > 0:
+			# always keep the newest entry, however large
+			while self.bytes > self.max_bytes and len(self.d) > 1:
+				self._evict()
 
 	def get(self, k):
 		try:
-			return self.d[k]
-		except:
+			e = self.d.pop(k)
+		except KeyError:
+			self.misses += 1
 			return None
+		self.d[k] = e		# now most recently used
+		self.hits += 1
+		return e[0]
 
 	def exists(self, k):
 		return k in self.d
 
+	def delete(self, k):
+		if k in self.d:
+			self.bytes -= self.d.pop(k)[1]
+
+	def stats(self):
+		return {
+			'entries' : len(self.d),
+			'bytes' : self.bytes,
+			'hits' : self.hits,
+			'misses' : self.misses,
+			'evictions' : self.evictions,
+		}
+
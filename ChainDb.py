@@ -6,21 +6,54 @@
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 #
 
-import string
 import cStringIO
+import struct
 import leveldb
-import io
 import os
 import time
+import zlib
 from decimal import Decimal
 from Cache import Cache
+from CoinsCache import CoinsCache
+from BlockStore import BlockStore
+from BlockIndex import BlockIndex, BLK_HAVE_DATA, BLK_HAVE_HEADER, BLK_PRUNED, \
+	BLK_COMPRESSED, BLK_FAILED
+from BloomFilter import BloomFilter
+from SigVerifier import SigVerifier
+from SigCache import SigCache
+from BlockImporter import BlockImporter
+from BlockPipeline import BlockPipeline
+from OrphanPool import OrphanPool
+from LazyBlock import LazyBlock
 from bitcoin.serialize import *
 from bitcoin.core import *
-from bitcoin.messages import msg_block, message_to_str, message_read
-from bitcoin.coredefs import COIN
+from bitcoin.messages import msg_block, message_to_str
+from bitcoin.coredefs import COIN, NETWORKS
 from bitcoin.scripteval import VerifySignature
 
 
+# on-disk layout version, stored at misc:schema.  Databases without that
+# key predate versioning (text tx: index) and count as version 0.
+# Run dbmigrate.py to upgrade an older database.
+DB_SCHEMA = 7
+
+# blocks are stored as network "block" messages: magic, command,
+# length and checksum precede the 80-byte header and tx list
+MSG_HDR_SIZE = 4 + 12 + 4 + 4
+BLK_HDR_SIZE = 80
+
+# blocks younger than this are committed one at a time
+SYNC_TIP_AGE = 24 * 60 * 60
+
+# BlkPos flags
+BLKPOS_PRUNED = 1	# block data deleted; position kept for reference
+BLKPOS_ZLIB = 2		# record is the zlib compressed block, no msg envelope
+
+# BlkMeta flags
+BLKMETA_FAILED = 1	# block is invalid: it failed a consensus check
+
+# difficulty changes every this many blocks
+RETARGET_INTERVAL = 2016
 
 def tx_blk_cmp(a, b):
 	if a.dFeePerKB != b.dFeePerKB:
@@ -32,51 +65,215 @@ def block_value(height, fees):
 	subsidy >>= (height / 210000)
 	return subsidy + fees
 
+def ser_block_header(block):
+	return (struct.pack("<i", block.nVersion) +
+		ser_uint256(block.hashPrevBlock) +
+		ser_uint256(block.hashMerkleRoot) +
+		struct.pack("<III", block.nTime, block.nBits, block.nNonce))
+
+def deser_block_header(s):
+	# a block with no transactions, as sent in "headers"
+	block = CBlock()
+	(block.nVersion, prevhash, merkle, block.nTime, block.nBits,
+	 block.nNonce) = struct.unpack("<i32s32sIII", s[:BLK_HDR_SIZE])
+	block.hashPrevBlock = uint256_from_str(prevhash)
+	block.hashMerkleRoot = uint256_from_str(merkle)
+	return block
+
+def block_work(nBits):
+	# expected number of hashes to find a block at this target
+	return (1L << 256) // (uint256_from_compact(nBits) + 1)
+
+def ser_compact_size(n):
+	if n < 253:
+		return chr(n)
+	elif n <= 0xffff:
+		return chr(253) + struct.pack("<H", n)
+	elif n <= 0xffffffffL:
+		return chr(254) + struct.pack("<I", n)
+	return chr(255) + struct.pack("<Q", n)
+
+def deser_compact_size(s, pos=0):
+	n = ord(s[pos])
+	if n < 253:
+		return (n, pos + 1)
+	elif n == 253:
+		return (struct.unpack("<H", s[pos+1:pos+3])[0], pos + 3)
+	elif n == 254:
+		return (struct.unpack("<I", s[pos+1:pos+5])[0], pos + 5)
+	return (struct.unpack("<Q", s[pos+1:pos+9])[0], pos + 9)
+
+def tx_positions(block, blkpos):
+	# file offset and length of each tx in a block stored at blkpos.
+	# in a compressed record, offset within the uncompressed block.
+	if blkpos.flags & BLKPOS_ZLIB:
+		base = 0
+	else:
+		base = blkpos.pos + MSG_HDR_SIZE
+	if isinstance(block, LazyBlock) and block.txpos is not None:
+		# already known from decoding the stored block
+		return [(base + pos, size) for (pos, size) in block.txpos]
+
+	pos = (base + BLK_HDR_SIZE +
+	       len(ser_compact_size(len(block.vtx))))
+	l = []
+	for tx in block.vtx:
+		txlen = len(tx.serialize())
+		l.append((pos, txlen))
+		pos += txlen
+	return l
+
+def block_size(block):
+	raw = getattr(block, 'raw', None)	# LazyBlock
+	if raw is not None:
+		return len(raw)
+	return len(block.serialize())
+
+def utxo_key(txhash, n):
+	# big-endian index keeps a transaction's outputs adjacent and ordered
+	return 'utxo:' + ser_uint256(txhash) + struct.pack(">I", n)
+
+class BlkPos(object):
+	def __init__(self, nFile=0, pos=0, size=0, flags=0):
+		self.nFile = nFile	# block file segment number
+		self.pos = pos		# offset within the segment
+		self.size = size	# record length
+		self.flags = flags	# BLKPOS_*
+
+	def deserialize(self, s, i=0):
+		(self.nFile, i) = deser_compact_size(s, i)
+		(self.pos, i) = deser_compact_size(s, i)
+		(self.size, i) = deser_compact_size(s, i)
+		# flags are optional, and omitted when zero
+		self.flags = 0
+		if i < len(s):
+			(self.flags, i) = deser_compact_size(s, i)
+		return i
+
+	def serialize(self):
+		s = (ser_compact_size(self.nFile) +
+		     ser_compact_size(self.pos) +
+		     ser_compact_size(self.size))
+		if self.flags:
+			s += ser_compact_size(self.flags)
+		return s
+
+	def __repr__(self):
+		return "BlkPos(file %d, pos %d, size %d, flags %d)" % (self.nFile, self.pos, self.size, self.flags)
+
+
 class TxIdx(object):
-	def __init__(self, blkhash=0L, spentmask=0L):
+	def __init__(self, blkhash=0L, nFile=0, pos=0, size=0):
 		self.blkhash = blkhash
-		self.spentmask = spentmask
+		self.nFile = nFile	# tx location in the block files
+		self.pos = pos
+		self.size = size
 
+	def deserialize(self, s):
+		if len(s) < 35:
+			raise RuntimeError
+		self.blkhash = uint256_from_str(s[:32])
+		(self.nFile, i) = deser_compact_size(s, 32)
+		(self.pos, i) = deser_compact_size(s, i)
+		self.size = deser_compact_size(s, i)[0]
+
+	def serialize(self):
+		return (ser_uint256(self.blkhash) +
+			ser_compact_size(self.nFile) +
+			ser_compact_size(self.pos) +
+			ser_compact_size(self.size))
+
+	def __repr__(self):
+		return "TxIdx(blkhash %064x, file %d, pos %d, size %d)" % (self.blkhash, self.nFile, self.pos, self.size)
 
-class BlkMeta(object):
-	def __init__(self):
-		self.height = -1
-		self.work = 0L
+
+class Utxo(object):
+	def __init__(self, nValue=0, scriptPubKey=''):
+		self.nValue = nValue
+		self.scriptPubKey = scriptPubKey
 
 	def deserialize(self, s):
-		l = s.split()
-		if len(l) < 2:
+		if len(s) < 8:
 			raise RuntimeError
-		self.height = int(l[0])
-		self.work = long(l[1], 16)
+		self.nValue = struct.unpack("<q", s[:8])[0]
+		self.scriptPubKey = s[8:]
 
 	def serialize(self):
-		r = str(self.height) + ' ' + hex(self.work)
-		return r
+		return struct.pack("<q", self.nValue) + self.scriptPubKey
+
+	def __repr__(self):
+		return "Utxo(nValue %d, scriptPubKey %s)" % (self.nValue, self.scriptPubKey.encode('hex'))
+
+
+class BlkUndo(object):
+	def __init__(self):
+		self.spent = []		# (txhash, n, Utxo) consumed by a block
+
+	def deserialize(self, s):
+		self.spent = []
+		(count, i) = deser_compact_size(s, 0)
+		for x in xrange(count):
+			txhash = uint256_from_str(s[i:i+32])
+			(n, i) = deser_compact_size(s, i + 32)
+			(size, i) = deser_compact_size(s, i)
+			utxo = Utxo()
+			utxo.deserialize(s[i:i+size])
+			i += size
+			self.spent.append((txhash, n, utxo))
+
+	def serialize(self):
+		l = [ser_compact_size(len(self.spent))]
+		for (txhash, n, utxo) in self.spent:
+			ser_utxo = utxo.serialize()
+			l.append(ser_uint256(txhash))
+			l.append(ser_compact_size(n))
+			l.append(ser_compact_size(len(ser_utxo)))
+			l.append(ser_utxo)
+		return ''.join(l)
 
 	def __repr__(self):
-		return "BlkMeta(height %d, work %x)" % (self.height, self.work)
+		return "BlkUndo(%d spent outputs)" % (len(self.spent),)
 
 
-class HeightIdx(object):
+class BlkMeta(object):
 	def __init__(self):
-		self.blocks = []
+		self.height = -1
+		self.work = 0L
+		self.prevhash = 0L
+		self.flags = 0		# BLKMETA_*
+		self.header = None	# serialized 80-byte header
 
 	def deserialize(self, s):
-		self.blocks = []
 		l = s.split()
-		for hashstr in l:
-			hash = long(hashstr, 16)
-			self.blocks.append(hash)
+		if len(l) < 3:
+			raise RuntimeError
+		self.height = int(l[0])
+		self.work = long(l[1], 16)
+		self.prevhash = long(l[2], 16)
+		self.flags = 0
+		if len(l) > 3:
+			self.flags = int(l[3])
+		# absent where dbmigrate had no block data to take it from
+		self.header = None
+		if len(l) > 4:
+			self.header = l[4].decode('hex')
 
 	def serialize(self):
-		l = []
-		for blkhash in self.blocks:
-			l.append(hex(blkhash))
-		return ' '.join(l)
+		r = (str(self.height) + ' ' + hex(self.work) + ' ' +
+		     hex(self.prevhash) + ' ' + str(self.flags))
+		if self.header is not None:
+			r += ' ' + self.header.encode('hex')
+		return r
 
 	def __repr__(self):
-		return "HeightIdx(blocks=%s)" % (self.serialize(),)
+		return "BlkMeta(height %d, work %x, prev %064x)" % (self.height, self.work, self.prevhash)
+
+
+def getschema(db):
+	try:
+		return int(db.Get('misc:schema'))
+	except KeyError:
+		return 0
 
 
 class ChainDb(object):
@@ -88,20 +285,67 @@ class ChainDb(object):
 		self.readonly = readonly
 		self.netmagic = netmagic
 		self.fast_dbm = fast_dbm
-		self.blk_cache = Cache(500)
-		self.orphans = {}
-		self.orphan_deps = {}
+		self.strict_bits = (netmagic.msg_start ==
+				    NETWORKS['mainnet'].msg_start)
+
+		# recently used blocks, up to 'blkcache' megabytes of
+		# serialized block data
+		blkcache = int(self.settings.get('blkcache', 50))
+		self.blk_cache = Cache(100000, blkcache * 1000 * 1000,
+				       block_size)
+
+		# blocks whose parent is unknown, up to 'orphanmem' megabytes
+		# and 'orphanexpiry' seconds old
+		orphanmem = int(self.settings.get('orphanmem', 32))
+		self.orphans = OrphanPool(orphanmem * 1000 * 1000,
+				int(self.settings.get('orphanexpiry', 3600)))
+
+		# signature checks for connect_block run in 'par' worker
+		# processes; started before anything large is loaded, as
+		# each is forked from this one
+		par = int(self.settings.get('par', 1))
+		self.sigverify = SigVerifier(par)
+
+		# set while a block is stored and connected.  signature
+		# checks may yield to other greenlets (see SigVerifier.idle),
+		# and blocks from them wait their turn.
+		self.connecting = False
+
+		# with workers, blocks are also parsed and checked in
+		# parallel before being stored and connected in order
+		self.pipeline = None
+		if par > 1:
+			self.pipeline = BlockPipeline(par)
+
+		# inputs verified on mempool entry, not checked again
+		# when their tx arrives in a block
+		self.sigcache = SigCache(int(self.settings.get('sigcache', 50000)))
 
 		# LevelDB to hold:
-		#    tx:*      transaction outputs
+		#    tx:*      transaction index (block, position in block files)
+		#    utxo:*    unspent transaction outputs
+		#    undo:*    outputs spent by each connected block
 		#    misc:*    state
-		#    height:*  list of blocks at height h
-		#    blkmeta:* block metadata
-		#    blocks:*  block seek point in stream
-		self.blk_write = io.BufferedWriter(io.FileIO(datadir + '/blocks.dat','ab'))
-		self.blk_read = io.BufferedReader(io.FileIO(datadir + '/blocks.dat','rb'))
+		#    blkmeta:* block metadata and header
+		#    blocks:*  block file number, offset and length
 		self.db = leveldb.LevelDB(datadir + '/leveldb')
 
+		# chain state (tx:, utxo: and the misc: best chain pointers)
+		# and block index updates are read and written through a
+		# write-back cache, flushed between blocks once it exceeds
+		# 'dbcache' megabytes
+		dbcache = int(self.settings.get('dbcache', 100))
+		self.coins = CoinsCache(self.db, dbcache * 1000 * 1000)
+
+		# block index and chain state writes are committed together.
+		# while syncing old blocks, one commit covers 'synccommit'
+		# blocks or 'synccommitsecs' seconds; near the tip, each
+		# block is committed on arrival.
+		self.sync_blocks = int(self.settings.get('synccommit', 500))
+		self.sync_secs = int(self.settings.get('synccommitsecs', 60))
+		self.n_uncommitted = 0
+		self.last_commit = time.time()
+
 		try:
 			self.db.Get('misc:height')
 		except KeyError:
@@ -111,6 +355,8 @@ class ChainDb(object):
 			batch.Put('misc:msg_start', self.netmagic.msg_start)
 			batch.Put('misc:tophash', ser_uint256(0L))
 			batch.Put('misc:total_work', hex(0L))
+			batch.Put('misc:schema', str(DB_SCHEMA))
+			batch.Put('misc:blkfile', '0 0')
 			self.db.Write(batch)
 
 		try:
@@ -120,62 +366,400 @@ class ChainDb(object):
 			self.log.write("Database magic number mismatch. Data corruption or incorrect network?")
 			raise RuntimeError
 
-	def puttxidx(self, txhash, txidx, batch=None):
+		schema = getschema(self.db)
+		if schema != DB_SCHEMA:
+			self.log.write("Database schema version %d, expected %d.  Run dbmigrate.py to upgrade." % (schema, DB_SCHEMA))
+			raise RuntimeError
+
+		# with 'prune' set, block data is held to about that many
+		# megabytes by deleting the oldest segment files, once all
+		# their blocks are 'prunedepth' blocks below the tip
+		self.prune_bytes = int(self.settings.get('prune', 0)) * 1000 * 1000
+		self.prune_depth = int(self.settings.get('prunedepth', 288))
+
+		# block data lives in blkNNNNN.dat segments of at most
+		# 'blkfilesize' MB, grown in 'blkprealloc' MB chunks
+		l = self.db.Get('misc:blkfile').split()
+		blkfilesize = int(self.settings.get('blkfilesize', 128))
+		blkprealloc = int(self.settings.get('blkprealloc', 16))
+		self.blkstore = BlockStore(datadir, int(l[0]), long(l[1]),
+					   blkfilesize * 1024 * 1024,
+					   blkprealloc * 1024 * 1024)
+
+		# zlib level new blocks are stored at, 0 for uncompressed.
+		# either kind of record can be read, whatever the setting.
+		self.blkcompress = int(self.settings.get('blkcompress', 0))
+
+		# every known block, kept in memory for chain walks, and
+		# the best chain as a height-indexed list of its nodes.
+		# blkfiles: segment -> [highest block, bytes of block data]
+		self.blkindex = BlockIndex()
+		self.blkfiles = {}
+		self.blk_bytes = 0
+		self.load_blkindex()
+		self.chain = []
+		self.load_mainchain()
+		self.log.write("ChainDb: committed tip height %d" % (len(self.chain) - 1,))
+
+		# the most-work chain of known headers, whose blocks are
+		# fetched in height order during headers-first sync
+		self.load_hdrchain()
+
+		# negative lookups for txids not in tx:, sized by 'txfilter'
+		# megabytes.  block lookups are answered by blkindex.
+		self.txfilter = None
+		txfilter = int(self.settings.get('txfilter', 32))
+		if txfilter > 0 and not self.readonly:
+			self.load_txfilter(txfilter * 1000 * 1000)
+
+		# segments left behind by a crash just after pruning
+		if self.prune_bytes > 0 and not self.readonly:
+			for nFile in xrange(self.blkstore.nFile):
+				if (nFile not in self.blkfiles and
+				    os.path.exists(self.blkstore.filename(nFile))):
+					self.blkstore.remove(nFile)
+
+	def load_blkindex(self):
+		prevhashes = {}
+		fail_height = None
+		for k, v in self.db.RangeIter('blkmeta:', 'blkmeta:' + ('\xff' * 32)):
+			blkhash = uint256_from_str(k[8:])
+			meta = BlkMeta()
+			meta.deserialize(v)
+			node = self.blkindex.add(blkhash, None, meta.height,
+						 meta.work)
+			node.status = BLK_HAVE_HEADER
+			if meta.flags & BLKMETA_FAILED:
+				node.status |= BLK_FAILED
+				if fail_height is None or node.height < fail_height:
+					fail_height = node.height
+			prevhashes[blkhash] = meta.prevhash
+		self.blkindex.link(prevhashes)
+
+		blkpos = BlkPos()
+		for k, v in self.db.RangeIter('blocks:', 'blocks:' + ('\xff' * 32)):
+			node = self.blkindex.get(uint256_from_str(k[7:]))
+			if node is None:
+				continue
+			blkpos.deserialize(v)
+			node.nFile = blkpos.nFile
+			node.pos = blkpos.pos
+			node.size = blkpos.size
+			if blkpos.flags & BLKPOS_ZLIB:
+				node.status |= BLK_COMPRESSED
+			if blkpos.flags & BLKPOS_PRUNED:
+				node.status |= BLK_PRUNED
+			else:
+				node.status |= BLK_HAVE_DATA
+				self.note_blkfile(node)
+
+		if fail_height is not None:
+			self.blkindex.fail_descendants(fail_height)
+
+		self.log.write("ChainDb: loaded %d block index entries" % (len(self.blkindex),))
+
+	def note_blkfile(self, node):
+		f = self.blkfiles.get(node.nFile)
+		if f is None:
+			f = self.blkfiles[node.nFile] = [node.height, 0]
+		f[0] = max(f[0], node.height)
+		f[1] += node.size
+		self.blk_bytes += node.size
+
+	def prune(self):
+		# delete the oldest segments whose blocks are all buried
+		# deep enough, until block data is within budget.  chain
+		# state and the block index are kept; the blocks are just
+		# no longer readable.
+		if self.prune_bytes <= 0 or self.readonly:
+			return 0
+		if self.blk_bytes <= self.prune_bytes:
+			return 0
+
+		max_height = self.getheight() - self.prune_depth
+		nbytes = self.blk_bytes
+		victims = set()
+		for nFile in sorted(self.blkfiles):
+			if nbytes <= self.prune_bytes:
+				break
+			f = self.blkfiles[nFile]
+			if nFile >= self.blkstore.nFile or f[0] > max_height:
+				continue	# being written, or too recent
+			victims.add(nFile)
+			nbytes -= f[1]
+		if not victims:
+			return 0
+
+		n_blocks = 0
+		for node in self.blkindex.nodes.itervalues():
+			if (node.nFile not in victims or
+			    not (node.status & BLK_HAVE_DATA)):
+				continue
+			node.status = (node.status & ~BLK_HAVE_DATA) | BLK_PRUNED
+			blkpos = self.node_blkpos(node)
+			blkpos.flags |= BLKPOS_PRUNED
+			self.coins.Put('blocks:'+ser_uint256(node.hash),
+				       blkpos.serialize())
+			self.blk_cache.delete(node.hash)
+			n_blocks += 1
+
+		# the entries must be marked before the data goes
+		self.commit()
+		for nFile in sorted(victims):
+			self.blk_bytes -= self.blkfiles.pop(nFile)[1]
+			self.blkstore.remove(nFile)
+
+		self.log.write("ChainDb: pruned %d blocks in %d segments, %d bytes of block data kept" % (
+			n_blocks, len(victims), self.blk_bytes))
+		return n_blocks
+
+	def load_txfilter(self, nbytes):
+		start = time.time()
+		self.txfilter = BloomFilter(nbytes)
+		for k in self.db.RangeIter('tx:', 'tx:' + ('\xff' * 32),
+					   include_value=False):
+			self.txfilter.add(uint256_from_str(k[3:]))
+
+		self.log.write("ChainDb: loaded %d txids into filter in %.1fs" % (
+			self.txfilter.n_added, time.time() - start))
+
+	def load_mainchain(self):
+		node = self.blkindex.get(self.gettophash())
+		if node is None:
+			self.chain = []
+			return
+
+		self.chain = [None] * (node.height + 1)
+		while node is not None:
+			self.chain[node.height] = node
+			node = node.prev
+
+	def load_hdrchain(self):
+		self.best_header = None
+		self.hdrchain = []
+		for node in self.blkindex.nodes.itervalues():
+			self.note_header(node)
+
+	def note_header(self, node):
+		if node.status & BLK_FAILED:
+			return
+		if (self.best_header is not None and
+		    node.work <= self.best_header.work):
+			return
+		self.best_header = node
+
+		# update the header chain from where it forks off
+		tail = []
+		while (node is not None and
+		       (node.height >= len(self.hdrchain) or
+			self.hdrchain[node.height] is not node)):
+			tail.append(node)
+			node = node.prev
+		tail.reverse()
+		if tail:
+			del self.hdrchain[tail[0].height:]
+			self.hdrchain.extend(tail)
+
+	def putheader(self, hdr):
+		# add a block header to the index, ahead of its body
+		hdr.calc_sha256()
+		if hdr.sha256 in self.blkindex:
+			return True
+
+		prev = self.blkindex.get(hdr.hashPrevBlock)
+		if prev is None:
+			self.log.write("Header %064x: unknown previous block" % (hdr.sha256,))
+			return False
+		if prev.status & BLK_FAILED:
+			self.log.write("Header %064x: builds on a failed block" % (hdr.sha256,))
+			return False
+		if hdr.sha256 > uint256_from_compact(hdr.nBits):
+			self.log.write("Header %064x: insufficient proof of work" % (hdr.sha256,))
+			return False
+
+		blkmeta = BlkMeta()
+		blkmeta.height = prev.height + 1
+		blkmeta.work = prev.work + block_work(hdr.nBits)
+		blkmeta.prevhash = hdr.hashPrevBlock
+		blkmeta.header = ser_block_header(hdr)
+
+		# difficulty only drops at a retarget, and then at most 4x.
+		# testnet allows minimum difficulty blocks, so is exempt.
+		if self.strict_bits and prev.prev is not None:
+			min_work = prev.work - prev.prev.work
+			if (blkmeta.height % RETARGET_INTERVAL) == 0:
+				min_work //= 4
+			if blkmeta.work - prev.work < min_work:
+				self.log.write("Header %064x: difficulty below its parent's" % (hdr.sha256,))
+				return False
+
+		chk_hash = self.netmagic.checkpoints.get(blkmeta.height)
+		if chk_hash is not None and chk_hash != hdr.sha256:
+			self.log.write("Header %064x does not match checkpoint, height %d" % (hdr.sha256, blkmeta.height))
+			return False
+
+		self.coins.Put('blkmeta:'+ser_uint256(hdr.sha256),
+			       blkmeta.serialize())
+		node = self.blkindex.add(hdr.sha256, hdr.hashPrevBlock,
+					 blkmeta.height, blkmeta.work)
+		node.status |= BLK_HAVE_HEADER
+		self.note_header(node)
+		return True
+
+	def blocks_to_fetch(self, max, skip, window=1024):
+		# missing blocks on the best header chain, lowest first,
+		# within 'window' heights of the first one missing
+		# from where the best header chain leaves ours.  having
+		# more work, it may still be the shorter of the two.
+		height = len(self.chain)
+		if (height > 0 and self.best_header is not None and
+		    not self.ismainchain(self.best_header.hash)):
+			fork = self.blkindex.fork_point(self.best_header,
+							self.chain[-1])
+			height = fork.height + 1
+
+		l = []
+		first = None
+		while height < len(self.hdrchain) and len(l) < max:
+			node = self.hdrchain[height]
+			if node.status & BLK_FAILED:
+				break
+			if not (node.status & BLK_HAVE_DATA):
+				if first is None:
+					first = height
+				elif height - first >= window:
+					break
+				if node.hash not in skip:
+					l.append(node)
+			height += 1
+		return l
+
+	def close(self):
+		n = self.coins.flush(True)
+		self.log.write("ChainDb: flushed %d cached entries" % (n,))
+		self.blkstore.close()
+		self.sigverify.close()
+		if self.pipeline is not None:
+			self.pipeline.close()
+		del self.coins
+		del self.db
+
+	def flush_if_full(self):
+		if not self.coins.full():
+			return
+		# a full cache is written out as a commit: the index it
+		# carries may point at block data not yet on disk
+		nbytes = self.coins.bytes
+		n = self.commit()
+		self.log.write("ChainDb: cache full (%d bytes), flushed %d entries" % (nbytes, n))
+
+	def commit(self):
+		# one synchronous write of everything since the last commit.
+		# misc:tophash goes with it, so after a crash the node
+		# resumes from the last committed block.  the block data it
+		# points at must be on disk first.
+		self.blkstore.sync()
+		n = self.coins.flush(True)
+		self.n_uncommitted = 0
+		self.last_commit = time.time()
+		return n
+
+	def commit_if_due(self, block):
+		self.n_uncommitted += 1
+		now = time.time()
+		if (self.n_uncommitted >= self.sync_blocks or
+		    now - self.last_commit >= self.sync_secs or
+		    now - block.nTime < SYNC_TIP_AGE):
+			self.commit()
+
+	def puttxidx(self, txhash, txidx):
 		ser_txhash = ser_uint256(txhash)
 
+		old_txidx = self.gettxidx(txhash)
+		if old_txidx is not None:
+			self.log.write("WARNING: overwriting duplicate TX %064x, height %d, oldblk %064x, newblk %064x" % (txhash, self.getheight(), old_txidx.blkhash, txidx.blkhash))
 
-		try:
-			self.db.Get('tx:'+ser_txhash)
-			old_txidx = self.gettxidx(txhash)
-			self.log.write("WARNING: overwriting duplicate TX %064x, height %d, oldblk %064x, oldspent %x, newblk %064x" % (txhash, self.getheight(), old_txidx.blkhash, old_txidx.spentmask, txidx.blkhash))
-		except KeyError:
-			pass
-		batch = self.db if batch is not None else batch
-		batch.Put('tx:'+ser_txhash, hex(txidx.blkhash) + ' ' +
-					       hex(txidx.spentmask))
+		# a miss above left a FRESH entry, which this Put preserves.
+		# a filter miss left no entry, but the key is known absent.
+		self.coins.Put('tx:'+ser_txhash, txidx.serialize(),
+			       old_txidx is None)
+		if self.txfilter is not None:
+			self.txfilter.add(txhash)
 
 		return True
 
 	def gettxidx(self, txhash):
+		if (self.txfilter is not None and
+		    not self.txfilter.contains(txhash)):
+			return None
+
 		ser_txhash = ser_uint256(txhash)
 		try:
-			ser_value = self.db.Get('tx:'+ser_txhash)
+			ser_value = self.coins.Get('tx:'+ser_txhash)
 		except KeyError:
 			return None
 
-		pos = string.find(ser_value, ' ')
-
 		txidx = TxIdx()
-		txidx.blkhash = long(ser_value[:pos], 16)
-		txidx.spentmask = long(ser_value[pos+1:], 16)
+		txidx.deserialize(ser_value)
 
 		return txidx
 
 	def gettx(self, txhash):
 		txidx = self.gettxidx(txhash)
-		if txidx is None:
+		if txidx is None or self.ispruned(txidx.blkhash):
 			return None
 
-		block = self.getblock(txidx.blkhash)
-		for tx in block.vtx:
-			tx.calc_sha256()
-			if tx.sha256 == txhash:
-				return tx
+		# read just this tx from the block file, or from the
+		# uncompressed block
+		if self.iscompressed(txidx.blkhash):
+			block = self.getblock(txidx.blkhash)
+			ser_tx = None
+			if block is not None:
+				ser_tx = block.serialize()[txidx.pos:txidx.pos+txidx.size]
+		else:
+			ser_tx = self.blkstore.view(txidx.nFile, txidx.pos,
+						    txidx.size)
+		if ser_tx is None:
+			self.log.write("ERROR: Missing TX %064x in block %064x" % (txhash, txidx.blkhash))
+			return None
 
-		self.log.write("ERROR: Missing TX %064x in block %064x" % (txhash, txidx.blkhash))
-		return None
+		tx = CTransaction()
+		tx.deserialize(cStringIO.StringIO(ser_tx))
+		tx.sha256 = txhash
+
+		return tx
+
+	def node_blkpos(self, node):
+		blkpos = BlkPos(node.nFile, node.pos, node.size)
+		if node.status & BLK_COMPRESSED:
+			blkpos.flags |= BLKPOS_ZLIB
+		return blkpos
+
+	def getblockpos(self, blkhash):
+		node = self.blkindex.get(blkhash)
+		if node is None or not (node.status & BLK_HAVE_DATA):
+			return None
+
+		return self.node_blkpos(node)
 
 	def haveblock(self, blkhash, checkorphans):
+		# true for pruned blocks too: they were stored and checked
 		if self.blk_cache.exists(blkhash):
 			return True
 		if checkorphans and blkhash in self.orphans:
 			return True
-		ser_hash = ser_uint256(blkhash)
-		try: 
-			self.db.Get('blocks:'+ser_hash)
-			return True
-		except KeyError:
+		node = self.blkindex.get(blkhash)
+		if node is None:
 			return False
+		return (node.status & (BLK_HAVE_DATA | BLK_PRUNED)) != 0
+
+	def ispruned(self, blkhash):
+		node = self.blkindex.get(blkhash)
+		return node is not None and (node.status & BLK_PRUNED) != 0
+
+	def iscompressed(self, blkhash):
+		node = self.blkindex.get(blkhash)
+		return node is not None and (node.status & BLK_COMPRESSED) != 0
 
 	def have_prevblock(self, block):
 		if self.getheight() < 0 and block.sha256 == self.netmagic.block0:
@@ -184,46 +768,127 @@ class ChainDb(object):
 			return True
 		return False
 
+	def getblock_raw(self, blkhash):
+		# serialized block, as a read-only buffer into the block file,
+		# or a string if it was stored compressed
+		blkpos = self.getblockpos(blkhash)
+		if blkpos is None:
+			return None
+
+		if blkpos.flags & BLKPOS_ZLIB:
+			rec = self.blkstore.view(blkpos.nFile, blkpos.pos,
+						 blkpos.size)
+			if rec is None:
+				return None
+			try:
+				return zlib.decompress(rec)
+			except zlib.error:
+				self.log.write("ERROR: Corrupt compressed block %064x" % (blkhash,))
+				return None
+
+		# skip the "block" msg envelope, checked when it was written
+		return self.blkstore.view(blkpos.nFile,
+					  blkpos.pos + MSG_HDR_SIZE,
+					  blkpos.size - MSG_HDR_SIZE)
+
+	def getheader(self, blkhash):
+		# from the index, so pruned blocks' headers are served too.
+		# read past the coins cache, which a peer's headers-first
+		# sync would otherwise fill.
+		try:
+			s = self.coins.peek('blkmeta:'+ser_uint256(blkhash))
+		except KeyError:
+			return None
+		meta = BlkMeta()
+		meta.deserialize(s)
+		if meta.header is None:
+			return None
+		return deser_block_header(meta.header)
+
 	def getblock(self, blkhash):
 		block = self.blk_cache.get(blkhash)
 		if block is not None:
 			return block
 
-		ser_hash = ser_uint256(blkhash)
-		try:
-			# Lookup the block index, seek in the file
-			fpos = long(self.db.Get('blocks:'+ser_hash))
-			self.blk_read.seek(fpos)
-
-			# read and decode "block" msg
-			msg = message_read(self.netmagic, self.blk_read)
-			if msg is None:
-				return None
-			block = msg.block
-		except KeyError:
+		ser_block = self.getblock_raw(blkhash)
+		if ser_block is None:
 			return None
 
+		# header now, transactions on first use of block.vtx
+		block = LazyBlock(ser_block, blkhash)
+
 		self.blk_cache.put(blkhash, block)
 
 		return block
 
-	def spend_txout(self, txhash, n_idx, batch=None):
-		txidx = self.gettxidx(txhash)
-		if txidx is None:
-			return False
+	def getutxo(self, txhash, n_idx):
+		try:
+			ser_value = self.coins.Get(utxo_key(txhash, n_idx))
+		except KeyError:
+			return None
+
+		utxo = Utxo()
+		utxo.deserialize(ser_value)
 
-		txidx.spentmask |= (1L << n_idx)
-		self.puttxidx(txhash, txidx, batch)
+		return utxo
+
+	def prefetch_utxos(self, outpts):
+		# outpoint -> Utxo, or None if not unspent on record
+		keys = {}
+		for outpt in outpts:
+			keys[utxo_key(outpt[0], outpt[1])] = outpt
+		values = self.coins.prefetch(keys.iterkeys())
+
+		r = {}
+		for k, ser_value in values.iteritems():
+			utxo = None
+			if ser_value is not None:
+				utxo = Utxo()
+				utxo.deserialize(ser_value)
+			r[keys[k]] = utxo
+		return r
+
+	def utxo_tx(self, txhash, n_idx):
+		# stand-in for a tx whose block was pruned, carrying only
+		# the unspent output at n_idx, for signature checks
+		utxo = self.getutxo(txhash, n_idx)
+		if utxo is None:
+			return None
+
+		tx = CTransaction()
+		tx.vout = [CTxOut() for i in xrange(n_idx)]
+		txout = CTxOut()
+		txout.nValue = utxo.nValue
+		txout.scriptPubKey = utxo.scriptPubKey
+		tx.vout.append(txout)
+		tx.sha256 = txhash
+
+		return tx
+
+	def pututxos(self, tx, fresh=False):
+		for n_idx in xrange(len(tx.vout)):
+			txout = tx.vout[n_idx]
+			utxo = Utxo(txout.nValue, txout.scriptPubKey)
+			self.coins.Put(utxo_key(tx.sha256, n_idx),
+				       utxo.serialize(), fresh)
+
+	def delutxos(self, tx):
+		for n_idx in xrange(len(tx.vout)):
+			self.coins.Delete(utxo_key(tx.sha256, n_idx))
+
+	def spend_txout(self, txhash, n_idx):
+		self.coins.Delete(utxo_key(txhash, n_idx))
 
 		return True
 
-	def clear_txout(self, txhash, n_idx, batch=None):
-		txidx = self.gettxidx(txhash)
-		if txidx is None:
+	def clear_txout(self, txhash, n_idx):
+		tx = self.gettx(txhash)
+		if tx is None or n_idx >= len(tx.vout):
 			return False
 
-		txidx.spentmask &= ~(1L << n_idx)
-		self.puttxidx(txhash, txidx, batch)
+		txout = tx.vout[n_idx]
+		utxo = Utxo(txout.nValue, txout.scriptPubKey)
+		self.coins.Put(utxo_key(txhash, n_idx), utxo.serialize())
 
 		return True
 
@@ -231,12 +896,13 @@ class ChainDb(object):
 		outpts = {}
 		txmap = {}
 		for tx in block.vtx:
-			if tx.is_coinbase:
-				continue
+			tx.calc_sha256()
 			txmap[tx.sha256] = tx
+			if tx.is_coinbase():
+				continue
 			for txin in tx.vin:
 				v = (txin.prevout.hash, txin.prevout.n)
-				if v in outs:
+				if v in outpts:
 					return None
 
 				outpts[v] = False
@@ -244,37 +910,37 @@ class ChainDb(object):
 		return (outpts, txmap)
 
 	def txout_spent(self, txout):
-		txidx = self.gettxidx(txout.hash)
-		if txidx is None:
-			return None
-
-		if txout.n > 100000:	# outpoint index sanity check
-			return None
+		# the common case, an unspent output, is a single point read
+		if self.getutxo(txout.hash, txout.n) is not None:
+			return False
 
-		if txidx.spentmask & (1L << txout.n):
+		# known tx without this output: spent, or index out of range
+		if self.gettxidx(txout.hash) is not None:
 			return True
 
-		return False
+		return None
 
 	def spent_outpts(self, block):
-		# list of outpoints this block wants to spend
+		# outpoints this block wants to spend -> Utxo on record, or
+		# None for outputs created earlier in the block
 		l = self.unique_outpts(block)
 		if l is None:
 			return None
 		outpts = l[0]
 		txmap = l[1]
-		spendlist = {}
+
+		# one sorted read of everything the block spends; the
+		# results also serve the undo record and the spends
+		utxos = self.prefetch_utxos(outpts.iterkeys())
 
 		# pass 1: if outpoint in db, make sure it is unspent
-		for k in outpts.iterkeys():
-			outpt = COutPoint()
-			outpt.hash = k[0]
-			outpt.n = k[1]
-			rc = self.txout_spent(outpt)
-			if rc is None:
+		for k in outpts.keys():
+			if utxos[k] is None:
+				# known tx without this output: spent, or
+				# index out of range
+				if self.gettxidx(k[0]) is not None:
+					return None
 				continue
-			if rc:
-				return None
 
 			outpts[k] = True	# skip in pass 2
 
@@ -292,24 +958,27 @@ class ChainDb(object):
 
 			# outpts[k] = True	# not strictly necessary
 
-		return outpts.keys()
+		return utxos
 
-	def tx_signed(self, tx, block, check_mempool):
+	def tx_signed(self, tx, blktxs, check_mempool):
 		tx.calc_sha256()
 
 		for i in xrange(len(tx.vin)):
 			txin = tx.vin[i]
+			if self.sigcache.contains(tx.sha256, i, 0):
+				continue
 
 			# search database for dependent TX
 			txfrom = self.gettx(txin.prevout.hash)
 
 			# search block for dependent TX
-			if txfrom is None and block is not None:
-				for blktx in block.vtx:
-					blktx.calc_sha256()
-					if blktx.sha256 == txin.prevout.hash:
-						txfrom = blktx
-						break
+			if txfrom is None and blktxs is not None:
+				txfrom = blktxs.get(txin.prevout.hash)
+
+			# the spent output alone, if its block was pruned
+			if txfrom is None:
+				txfrom = self.utxo_tx(txin.prevout.hash,
+						      txin.prevout.n)
 
 			# search mempool for dependent TX
 			if txfrom is None and check_mempool:
@@ -330,9 +999,46 @@ class ChainDb(object):
 				self.log.write("TX %064x/%d sigfail" %
 						(tx.sha256, i))
 				return False
+			self.sigcache.add(tx.sha256, i, 0)
 
 		return True
 
+	def sig_checks(self, block):
+		# each non-coinbase tx with the txs its inputs spend, which
+		# may come earlier in the same block
+		blktxs = {}
+		for tx in block.vtx:
+			tx.calc_sha256()
+			blktxs[tx.sha256] = tx
+
+		checks = []
+		for tx in block.vtx:
+			if tx.is_coinbase():
+				continue
+
+			inputs = []
+			for i in xrange(len(tx.vin)):
+				if self.sigcache.contains(tx.sha256, i, 0):
+					continue
+				txin = tx.vin[i]
+				txfrom = self.gettx(txin.prevout.hash)
+				if txfrom is None:
+					txfrom = blktxs.get(txin.prevout.hash)
+				if txfrom is None:
+					txfrom = self.utxo_tx(txin.prevout.hash,
+							      txin.prevout.n)
+				if txfrom is None:
+					self.log.write("TX %064x/%d no-dep %064x" %
+							(tx.sha256, i,
+							 txin.prevout.hash))
+					self.log.write("Invalid signature in block %064x" % (block.sha256, ))
+					return None
+				inputs.append((i, txfrom))
+			if inputs:
+				checks.append((tx, inputs))
+
+		return checks
+
 	def tx_is_orphan(self, tx):
 		if not tx.is_valid():
 			return None
@@ -353,99 +1059,138 @@ class ChainDb(object):
 
 	def connect_block(self, ser_hash, block, blkmeta):
 		# verify against checkpoint list
-		try:
-			chk_hash = self.netmagic.checkpoints[blkmeta.height]
-			if chk_hash != block.sha256:
-				self.log.write("Block %064x does not match checkpoint hash %064x, height %d" % (
-					block.sha256, chk_hash, blkmeta.height))
-				return False
-		except KeyError:
-			pass
+		chk_hash = self.netmagic.checkpoints.get(blkmeta.height)
+		if chk_hash is not None and chk_hash != block.sha256:
+			self.log.write("Block %064x does not match checkpoint hash %064x, height %d" % (
+				block.sha256, chk_hash, blkmeta.height))
+			self.mark_failed(block.sha256)
+			return False
 			
 		# check TX connectivity
 		outpts = self.spent_outpts(block)
 		if outpts is None:
 			self.log.write("Unconnectable block %064x" % (block.sha256, ))
+			self.mark_failed(block.sha256)
 			return False
 
 		# verify script signatures
 		if ('nosig' not in self.settings and
 		    ('forcesig' in self.settings or
 		     blkmeta.height > self.netmagic.checkpoint_max)):
-			for tx in block.vtx:
-				tx.calc_sha256()
+			checks = self.sig_checks(block)
+			if checks is None:
+				return False
 
-				if tx.is_coinbase():
-					continue
+			failed = self.sigverify.verify(checks)
+			if failed is not None and failed[2] is not None:
+				# the check could not run: no verdict
+				self.log.write("TX %064x/%d signature check error: %s" % (
+						failed[0].sha256, failed[1], failed[2]))
+				return False
+			if failed is not None:
+				self.log.write("TX %064x/%d sigfail" % (
+						failed[0].sha256, failed[1]))
+				self.log.write("Invalid signature in block %064x" % (block.sha256, ))
+				self.mark_failed(block.sha256)
+				return False
 
-				if not self.tx_signed(tx, block, False):
-					self.log.write("Invalid signature in block %064x" % (block.sha256, ))
-					return False
+		# update database pointers for best chain.  these go through
+		# the coins cache too, so flushed state is always consistent.
+		self.coins.Put('misc:total_work', hex(blkmeta.work))
+		self.coins.Put('misc:height', str(blkmeta.height))
+		self.coins.Put('misc:tophash', ser_hash)
 
-		# update database pointers for best chain
-		batch = leveldb.WriteBatch()
-		batch.Put('misc:total_work', hex(blkmeta.work))
-		batch.Put('misc:height', str(blkmeta.height))
-		batch.Put('misc:tophash', ser_hash)
+		node = self.blkindex.get(block.sha256)
+		del self.chain[node.height:]
+		self.chain.append(node)
 
 		self.log.write("ChainDb: height %d, block %064x" % (
 				blkmeta.height, block.sha256))
 
+		# record the outputs this block consumes, for disconnect.
+		# outputs created inside the block are not on record yet,
+		# and need no undo: disconnecting deletes them anyway.
+		undo = BlkUndo()
+		for outpt, utxo in outpts.iteritems():
+			if utxo is not None:
+				undo.spent.append((outpt[0], outpt[1], utxo))
+		self.coins.Put('undo:'+ser_hash, undo.serialize(), True)
+
 		# all TX's in block are connectable; index
 		neverseen = 0
-		for tx in block.vtx:
-                        tx.calc_sha256()
+		blkpos = self.getblockpos(block.sha256)
+		txpos = tx_positions(block, blkpos)
+		for i in xrange(len(block.vtx)):
+			tx = block.vtx[i]
+			tx.calc_sha256()
 
 			if not self.mempool.remove(tx.sha256):
 				neverseen += 1
 
-			txidx = TxIdx(block.sha256)
-			if not self.puttxidx(tx.sha256, txidx, batch):
+			# outputs of a never-seen tx cannot be on disk yet
+			fresh = self.gettxidx(tx.sha256) is None
+
+			txidx = TxIdx(block.sha256, blkpos.nFile,
+				      txpos[i][0], txpos[i][1])
+			if not self.puttxidx(tx.sha256, txidx):
 				self.log.write("TxIndex failed %064x" % (tx.sha256,))
 				return False
 
+			self.pututxos(tx, fresh)
+
 		self.log.write("MemPool: blk.vtx.sz %d, neverseen %d, poolsz %d" % (len(block.vtx), neverseen, self.mempool.size()))
 
-		# mark deps as spent
+		# mark deps as spent.  outputs created earlier in this same
+		# block were Put above and are simply dropped from the cache.
 		for outpt in outpts:
-			self.spend_txout(outpt[0], outpt[1], batch)
+			self.spend_txout(outpt[0], outpt[1])
 
-		self.db.Write(batch)
+		self.flush_if_full()
 		return True
 
 	def disconnect_block(self, block):
 		ser_prevhash = ser_uint256(block.hashPrevBlock)
-		prevmeta = BlkMeta()
-		prevmeta.deserialize(self.db.Get('blkmeta:'+ser_prevhash))
-
-		tup = self.unique_outpts(block)
-		if tup is None:
-			return False
+		prevmeta = self.getblockmeta(block.hashPrevBlock)
 
-		outpts = tup[0]
-
-		# mark deps as unspent
-		batch = leveldb.WriteBatch()
-		for outpt in outpts:
-			self.clear_txout(outpt[0], outpt[1], batch)
+		ser_blkhash = ser_uint256(block.sha256)
+		try:
+			undo = BlkUndo()
+			undo.deserialize(self.coins.Get('undo:'+ser_blkhash))
+		except KeyError:
+			# connected before undo records existed: rebuild
+			# each spent output from its funding tx instead
+			undo = None
+			tup = self.unique_outpts(block)
+			if tup is None:
+				return False
 
 		# update tx index and memory pool
 		for tx in block.vtx:
 			tx.calc_sha256()
 			ser_hash = ser_uint256(tx.sha256)
-			try:
-				batch.Delete('tx:'+ser_hash)
-			except KeyError:
-				pass
+			self.coins.Delete('tx:'+ser_hash)
+			self.delutxos(tx)
 
 			if not tx.is_coinbase():
 				self.mempool.add(tx)
 
+		# mark deps as unspent
+		if undo is not None:
+			for (txhash, n, utxo) in undo.spent:
+				self.coins.Put(utxo_key(txhash, n),
+					       utxo.serialize())
+			self.coins.Delete('undo:'+ser_blkhash)
+		else:
+			for outpt in tup[0]:
+				self.clear_txout(outpt[0], outpt[1])
+
 		# update database pointers for best chain
-		batch.Put('misc:total_work', hex(prevmeta.work))
-		batch.Put('misc:height', str(prevmeta.height))
-		batch.Put('misc:tophash', ser_prevhash)
-		self.db.Write(batch)
+		self.coins.Put('misc:total_work', hex(prevmeta.work))
+		self.coins.Put('misc:height', str(prevmeta.height))
+		self.coins.Put('misc:tophash', ser_prevhash)
+		self.flush_if_full()
+
+		del self.chain[prevmeta.height+1:]
 
 		self.log.write("ChainDb(disconn): height %d, block %064x" % (
 				prevmeta.height, block.hashPrevBlock))
@@ -453,21 +1198,24 @@ class ChainDb(object):
 		return True
 
 	def getblockmeta(self, blkhash):
-		ser_hash = ser_uint256(blkhash)
-		try:
-			meta = BlkMeta()
-			meta.deserialize(self.db.Get('blkmeta:'+ser_hash))
-		except KeyError:
+		node = self.blkindex.get(blkhash)
+		if node is None:
 			return None
 
+		meta = BlkMeta()
+		meta.height = node.height
+		meta.work = node.work
+		if node.prev is not None:
+			meta.prevhash = node.prev.hash
+
 		return meta
 	
 	def getblockheight(self, blkhash):
-		meta = self.getblockmeta(blkhash)
-		if meta is None:
+		node = self.blkindex.get(blkhash)
+		if node is None:
 			return -1
 
-		return meta.height
+		return node.height
 
 	def reorganize(self, new_best_blkhash):
 		self.log.write("REORGANIZE")
@@ -476,42 +1224,44 @@ class ChainDb(object):
 		disconn = []
 
 		old_best_blkhash = self.gettophash()
-		fork = old_best_blkhash
-		longer = new_best_blkhash
-		while fork != longer:
-			while (self.getblockheight(longer) >
-			       self.getblockheight(fork)):
-				block = self.getblock(longer)
-				block.calc_sha256()
-				conn.append(block)
-
-				longer = block.hashPrevBlock
-				if longer == 0:
-					return False
+		old_node = self.blkindex.get(old_best_blkhash)
+		new_node = self.blkindex.get(new_best_blkhash)
+		fork = self.blkindex.fork_point(old_node, new_node)
+		if fork is None:
+			return False
 
-			if fork == longer:
-				break
+		node = old_node
+		while node is not fork:
+			disconn.append(node)
+			node = node.prev
 
-			block = self.getblock(fork)
-			block.calc_sha256()
-			disconn.append(block)
+		node = new_node
+		while node is not fork:
+			conn.append(node)
+			node = node.prev
+		conn.reverse()
 
-			fork = block.hashPrevBlock
-			if fork == 0:
+		for node in disconn + conn:
+			if node.status & BLK_PRUNED:
+				self.log.write("REORG needs pruned block %064x, height %d" % (node.hash, node.height))
 				return False
 
 		self.log.write("REORG disconnecting top hash %064x" % (old_best_blkhash,))
 		self.log.write("REORG connecting new top hash %064x" % (new_best_blkhash,))
-		self.log.write("REORG chain union point %064x" % (fork,))
+		self.log.write("REORG chain union point %064x" % (fork.hash,))
 		self.log.write("REORG disconnecting %d blocks, connecting %d blocks" % (len(disconn), len(conn)))
 
-		for block in disconn:
+		for node in disconn:
+			block = self.getblock(node.hash)
+			block.calc_sha256()
 			if not self.disconnect_block(block):
 				return False
 
-		for block in conn:
-			if not self.connect_block(ser_uint256(block.sha256),
-				  block, self.getblockmeta(block.sha256)):
+		for node in conn:
+			block = self.getblock(node.hash)
+			block.calc_sha256()
+			if not self.connect_block(ser_uint256(node.hash),
+				  block, self.getblockmeta(node.hash)):
 				return False
 
 		self.log.write("REORGANIZE DONE")
@@ -520,13 +1270,31 @@ class ChainDb(object):
 	def set_best_chain(self, ser_prevhash, ser_hash, block, blkmeta):
 		# the easy case, extending current best chain
 		if (blkmeta.height == 0 or
-		    self.db.Get('misc:tophash') == ser_prevhash):
+		    self.coins.Get('misc:tophash') == ser_prevhash):
 			return self.connect_block(ser_hash, block, blkmeta)
 
 		# switching from current chain to another, stronger chain
 		return self.reorganize(block.sha256)
 
-	def putoneblock(self, block):
+	def mark_failed(self, blkhash):
+		# for consensus failures only: the block and all built on
+		# it are never fetched or connected again
+		node = self.blkindex.get(blkhash)
+		self.log.write("Block %064x failed, height %d" % (node.hash, node.height))
+		self.blkindex.fail(node)
+
+		k = 'blkmeta:'+ser_uint256(blkhash)
+		meta = BlkMeta()
+		meta.deserialize(self.coins.Get(k))
+		meta.flags |= BLKMETA_FAILED
+		self.coins.Put(k, meta.serialize())
+
+		# the best header chain may run through it
+		if (self.best_header is not None and
+		    (self.best_header.status & BLK_FAILED)):
+			self.load_hdrchain()
+
+	def putoneblock(self, block, peer=None):
 		block.calc_sha256()
 
 		if not block.is_valid():
@@ -534,147 +1302,166 @@ class ChainDb(object):
 			return False
 
 		if not self.have_prevblock(block):
-			self.orphans[block.sha256] = True
-			self.orphan_deps[block.hashPrevBlock] = block
-			self.log.write("Orphan block %064x (%d orphans)" % (block.sha256, len(self.orphan_deps)))
+			self.orphans.add(block, block_size(block), peer)
+			self.log.write("Orphan block %064x (%d orphans, %d bytes)" % (block.sha256, len(self.orphans), self.orphans.bytes))
+			return False
+
+		prev = self.blkindex.get(block.hashPrevBlock)
+		if prev is not None and (prev.status & BLK_FAILED):
+			self.log.write("Block %064x builds on a failed block" % (block.sha256, ))
 			return False
 
 		top_height = self.getheight()
-		top_work = long(self.db.Get('misc:total_work'), 16)
+		top_work = long(self.coins.Get('misc:total_work'), 16)
 
 		# read metadata for previous block
 		prevmeta = BlkMeta()
 		if top_height >= 0:
 			ser_prevhash = ser_uint256(block.hashPrevBlock)
-			prevmeta.deserialize(self.db.Get('blkmeta:'+ser_prevhash))
+			prevmeta = self.getblockmeta(block.hashPrevBlock)
 		else:
 			ser_prevhash = ''
 
-		batch = leveldb.WriteBatch()
-
-		# build network "block" msg, as canonical disk storage form
-		msg = msg_block()
-		msg.block = block
-		msg_data = message_to_str(self.netmagic, msg)
-
-		# write "block" msg to storage
-		fpos = self.blk_write.tell()
-		self.blk_write.write(msg_data)
-		self.blk_write.flush()
-
-		# add index entry
+		# build network "block" msg, as canonical disk storage form,
+		# or with 'blkcompress', the compressed block if smaller
+		flags = 0
+		if self.blkcompress > 0:
+			ser_block = block.serialize()
+			rec = zlib.compress(ser_block, self.blkcompress)
+			if len(rec) < len(ser_block) + MSG_HDR_SIZE:
+				flags = BLKPOS_ZLIB
+		if not flags:
+			msg = msg_block()
+			msg.block = block
+			rec = message_to_str(self.netmagic, msg)
+
+		# write record to storage
+		(nFile, pos) = self.blkstore.write(rec)
+
+		# add index entry, and advance the saved write cursor.
+		# these reach the database with the next commit, so a crash
+		# before it just leaves the data to be overwritten.
 		ser_hash = ser_uint256(block.sha256)
-		batch.Put('blocks:'+ser_hash, str(fpos))
+		blkpos = BlkPos(nFile, pos, len(rec), flags)
+		self.coins.Put('blocks:'+ser_hash, blkpos.serialize())
+		self.coins.Put('misc:blkfile', "%d %d" % (self.blkstore.nFile,
+							  self.blkstore.pos))
 
 		# store metadata related to this block
 		blkmeta = BlkMeta()
 		blkmeta.height = prevmeta.height + 1
-		blkmeta.work = (prevmeta.work +
-				uint256_from_compact(block.nBits))
-		batch.Put('blkmeta:'+ser_hash, blkmeta.serialize())
-
-		# store list of blocks at this height
-		heightidx = HeightIdx()
-		heightstr = str(blkmeta.height)
-		try:
-			heightidx.deserialize(self.db.Get('height:'+heightstr))
-		except KeyError:
-			pass
-		heightidx.blocks.append(block.sha256)
-
-		batch.Put('height:'+heightstr, heightidx.serialize())
-		self.db.Write(batch)
+		blkmeta.work = prevmeta.work + block_work(block.nBits)
+		blkmeta.prevhash = block.hashPrevBlock
+		blkmeta.header = ser_block_header(block)
+		self.coins.Put('blkmeta:'+ser_hash, blkmeta.serialize())
+
+		node = self.blkindex.add(block.sha256, block.hashPrevBlock,
+					 blkmeta.height, blkmeta.work)
+		node.nFile = nFile
+		node.pos = pos
+		node.size = len(rec)
+		node.status |= BLK_HAVE_DATA | BLK_HAVE_HEADER
+		if flags & BLKPOS_ZLIB:
+			node.status |= BLK_COMPRESSED
+		self.note_header(node)
+		self.note_blkfile(node)
 
 		# if chain is not best chain, proceed no further
 		if (blkmeta.work <= top_work):
 			self.log.write("ChainDb: height %d (weak), block %064x" % (blkmeta.height, block.sha256))
+			self.commit_if_due(block)
 			return True
 
 		# update global chain pointers
-		if not self.set_best_chain(ser_prevhash, ser_hash,
-					   block, blkmeta):
-			return False
+		rc = self.set_best_chain(ser_prevhash, ser_hash, block, blkmeta)
+		self.commit_if_due(block)
+		self.prune()
+		return rc
 
-		return True
+	def putblock(self, block, peer=None):
+		while self.connecting:
+			self.sigverify.idle()
+
+		self.connecting = True
+		try:
+			return self.putblocks(block, peer)
+		finally:
+			self.connecting = False
 
-	def putblock(self, block):
+	def putblocks(self, block, peer):
+		# the block, then any orphans it completes
 		block.calc_sha256()
 		if self.haveblock(block.sha256, True):
 			self.log.write("Duplicate block %064x submitted" % (block.sha256, ))
 			return False
 
-		if not self.putoneblock(block):
+		if not self.putoneblock(block, peer):
 			return False
 
-		blkhash = block.sha256
-		while blkhash in self.orphan_deps:
-			block = self.orphan_deps[blkhash]
-			if not self.putoneblock(block):
-				return True
+		# connect every orphan descending from this block
+		blkhashes = [block.sha256]
+		while blkhashes:
+			for block in self.orphans.pop_children(blkhashes.pop()):
+				if self.putoneblock(block):
+					blkhashes.append(block.sha256)
 
-			del self.orphan_deps[blkhash]
-			del self.orphans[block.sha256]
+		return True
 
-			blkhash = block.sha256
+	def getblockhash(self, height):
+		# hash of the best chain block at height, or None
+		if height < 0 or height >= len(self.chain):
+			return None
+		return self.chain[height].hash
 
-		return True
+	def ismainchain(self, blkhash):
+		node = self.blkindex.get(blkhash)
+		if node is None or node.height >= len(self.chain):
+			return False
+		return self.chain[node.height] is node
 
 	def locate(self, locator):
+		# first locator entry on our best chain, else genesis
 		for hash in locator.vHave:
-			ser_hash = ser_uint256(hash)
-			if ser_hash in self.blkmeta:
-				blkmeta = BlkMeta()
-				blkmeta.deserialize(self.db.Get('blkmeta:'+ser_hash))
-				return blkmeta
-		return 0
+			if self.ismainchain(hash):
+				return self.blkindex.get(hash)
+		if len(self.chain) == 0:
+			return None
+		return self.chain[0]
 
 	def getheight(self):
-		return int(self.db.Get('misc:height'))
+		return int(self.coins.Get('misc:height'))
 
 	def gettophash(self):
-		return uint256_from_str(self.db.Get('misc:tophash'))
-
-	def loadfile(self, filename):
-		fd = os.open(filename, os.O_RDONLY)
-		self.log.write("IMPORTING DATA FROM " + filename)
-		buf = ''
-		wanted = 4096
-		while True:
-			if wanted > 0:
-				if wanted < 4096:
-					wanted = 4096
-				s = os.read(fd, wanted)
-				if len(s) == 0:
-					break
-
-				buf += s
-				wanted = 0
-
-			buflen = len(buf)
-			startpos = string.find(buf, self.netmagic.msg_start)
-			if startpos < 0:
-				wanted = 8
-				continue
-
-			sizepos = startpos + 4
-			blkpos = startpos + 8
-			if blkpos > buflen:
-				wanted = 8
-				continue
-
-			blksize = struct.unpack("<i", buf[sizepos:blkpos])[0]
-			if (blkpos + blksize) > buflen:
-				wanted = 8 + blksize
-				continue
-
-			ser_blk = buf[blkpos:blkpos+blksize]
-			buf = buf[blkpos+blksize:]
+		return uint256_from_str(self.coins.Get('misc:tophash'))
 
-			f = cStringIO.StringIO(ser_blk)
-			block = CBlock()
-			block.deserialize(f)
+	def get_import_pos(self, filename):
+		# where an interrupted import of this file left off
+		try:
+			l = self.db.Get('misc:import').split(' ', 1)
+		except KeyError:
+			return 0
+		if l[1] != os.path.abspath(filename):
+			return 0
+		return long(l[0])
+
+	def set_import_pos(self, filename, pos):
+		# committed with the blocks, so it never runs ahead of them
+		self.coins.Put('misc:import', "%d %s" % (pos,
+					os.path.abspath(filename)))
+
+	def loadfile(self, filename, start=None):
+		if start is None:
+			start = self.get_import_pos(filename)
+		if start > 0:
+			self.log.write("IMPORTING DATA FROM %s, resuming at offset %d" % (filename, start))
+		else:
+			self.log.write("IMPORTING DATA FROM " + filename)
 
-			self.putblock(block)
+		importer = BlockImporter(self, self.log,
+				int(self.settings.get('loadorphans', 1000)),
+				self.pipeline)
+		importer.load(filename, start)
+		self.commit()
 
 	def newblock_txs(self):
 		txlist = []
@@ -691,12 +1478,12 @@ class ChainDb(object):
 			dPriority = Decimal(0)
 
 			for tin in tx.vin:
-				in_tx = self.gettx(tin.prevout.hash)
-				if (in_tx is None or
-				    tin.prevout.n >= len(in_tx.vout)):
+				utxo = self.getutxo(tin.prevout.hash,
+						    tin.prevout.n)
+				if utxo is None:
 					valid = False
 				else:
-					v = in_tx.vout[tin.prevout.n].nValue
+					v = utxo.nValue
 					nValueIn += v
 					dPriority += Decimal(v * 1)
 
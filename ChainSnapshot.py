@@ -0,0 +1,134 @@
+#
+# ChainSnapshot.py - chain state snapshot files, for bootstrapping a node
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import zlib
+import struct
+import hashlib
+
+from bitcoin.serialize import ser_uint256, uint256_from_str
+from ChainDb import ser_compact_size
+
+# file layout:
+#    header    magic, version, network magic, height, block hash
+#    records   zlib stream of (key, value) database records, in key
+#              order, ended by an empty key and the sha256 of the
+#              header and all uncompressed bytes before it
+SNAPSHOT_MAGIC = 'pychainstate'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HDR_SIZE = len(SNAPSHOT_MAGIC) + 4 + 4 + 4 + 32
+
+CHUNK_SIZE = 64 * 1024
+
+
+class SnapshotWriter(object):
+	def __init__(self, f, msg_start, height, blkhash):
+		self.f = f
+		self.h = hashlib.sha256()
+		self.z = zlib.compressobj(6)
+		self.pending = []
+		self.pending_bytes = 0
+		self.n_records = 0
+
+		hdr = (SNAPSHOT_MAGIC + struct.pack("<I", SNAPSHOT_VERSION) +
+		       msg_start + struct.pack("<i", height) +
+		       ser_uint256(blkhash))
+		self.h.update(hdr)
+		self.f.write(hdr)
+
+	def write(self, s):
+		self.h.update(s)
+		self.pending.append(s)
+		self.pending_bytes += len(s)
+		if self.pending_bytes >= CHUNK_SIZE:
+			self.flush()
+
+	def flush(self):
+		self.f.write(self.z.compress(''.join(self.pending)))
+		self.pending = []
+		self.pending_bytes = 0
+
+	def put(self, k, v):
+		self.write(ser_compact_size(len(k)) + k +
+			   ser_compact_size(len(v)) + v)
+		self.n_records += 1
+
+	def close(self):
+		self.write(ser_compact_size(0))
+		self.pending.append(self.h.digest())
+		self.flush()
+		self.f.write(self.z.flush())
+
+
+class SnapshotReader(object):
+	def __init__(self, f):
+		self.f = f
+		self.h = hashlib.sha256()
+		self.z = zlib.decompressobj()
+		self.buf = ''
+		self.pos = 0
+		self.n_records = 0
+
+		hdr = f.read(SNAPSHOT_HDR_SIZE)
+		i = len(SNAPSHOT_MAGIC)
+		if len(hdr) != SNAPSHOT_HDR_SIZE or hdr[:i] != SNAPSHOT_MAGIC:
+			raise RuntimeError("not a chain state snapshot")
+		version = struct.unpack("<I", hdr[i:i+4])[0]
+		if version != SNAPSHOT_VERSION:
+			raise RuntimeError("snapshot version %d, expected %d" % (version, SNAPSHOT_VERSION))
+		self.msg_start = hdr[i+4:i+8]
+		self.height = struct.unpack("<i", hdr[i+8:i+12])[0]
+		self.blkhash = uint256_from_str(hdr[i+12:i+44])
+		self.h.update(hdr)
+
+	def read(self, n):
+		while len(self.buf) - self.pos < n:
+			s = self.f.read(CHUNK_SIZE)
+			if s:
+				s = self.z.decompress(s)
+			else:
+				s = self.z.flush()
+				if not s:
+					raise RuntimeError("snapshot truncated")
+			self.buf = self.buf[self.pos:] + s
+			self.pos = 0
+
+		r = self.buf[self.pos:self.pos+n]
+		self.pos += n
+		return r
+
+	def read_compact_size(self):
+		s = self.read(1)
+		n = ord(s)
+		if n == 253:
+			s += self.read(2)
+			n = struct.unpack("<H", s[1:])[0]
+		elif n == 254:
+			s += self.read(4)
+			n = struct.unpack("<I", s[1:])[0]
+		elif n == 255:
+			s += self.read(8)
+			n = struct.unpack("<Q", s[1:])[0]
+		self.h.update(s)
+		return n
+
+	def records(self):
+		# yields (key, value) in key order.  the checksum is only
+		# known at the end: callers must not treat what they have
+		# read as valid until this has run to completion.
+		while True:
+			klen = self.read_compact_size()
+			if klen == 0:
+				break
+			k = self.read(klen)
+			self.h.update(k)
+			v = self.read(self.read_compact_size())
+			self.h.update(v)
+			self.n_records += 1
+			yield (k, v)
+
+		if self.read(32) != self.h.digest():
+			raise RuntimeError("snapshot checksum mismatch")
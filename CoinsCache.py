@@ -0,0 +1,146 @@
+#
+# CoinsCache.py - write-back cache in front of the chain state database
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import leveldb
+
+# entry flags
+DIRTY = 1	# differs from the database; written at next flush
+FRESH = 2	# known absent from the database; may be dropped on delete
+
+# rough per-entry cost of the dict slot, list and strings, in bytes
+ENTRY_OVERHEAD = 120
+
+
+class CoinsCache(object):
+	def __init__(self, db, max_bytes):
+		self.db = db
+		self.max_bytes = max_bytes
+		self.d = {}		# key -> [value or None, flags]
+		self.bytes = 0
+		self.n_dirty = 0
+		self.hits = 0
+		self.misses = 0
+		self.flushes = 0
+
+	def _size(self, k, v):
+		if v is None:
+			return ENTRY_OVERHEAD + len(k)
+		return ENTRY_OVERHEAD + len(k) + len(v)
+
+	def _set(self, k, v, flags):
+		old = self.d.get(k)
+		if old is not None:
+			self.bytes -= self._size(k, old[0])
+			if old[1] & DIRTY:
+				self.n_dirty -= 1
+		self.d[k] = [v, flags]
+		self.bytes += self._size(k, v)
+		if flags & DIRTY:
+			self.n_dirty += 1
+
+	def _drop(self, k):
+		old = self.d.pop(k)
+		self.bytes -= self._size(k, old[0])
+		if old[1] & DIRTY:
+			self.n_dirty -= 1
+
+	# Get/Put/Delete mirror the leveldb API, including KeyError on miss
+	def Get(self, k):
+		ent = self.d.get(k)
+		if ent is not None:
+			self.hits += 1
+		else:
+			self.misses += 1
+			try:
+				v = self.db.Get(k)
+				ent = [v, 0]
+			except KeyError:
+				ent = [None, FRESH]
+			self._set(k, ent[0], ent[1])
+
+		if ent[0] is None:
+			raise KeyError(k)
+		return ent[0]
+
+	def peek(self, k):
+		# Get, without caching a miss
+		ent = self.d.get(k)
+		if ent is None:
+			return self.db.Get(k)
+		if ent[0] is None:
+			raise KeyError(k)
+		return ent[0]
+
+	def Put(self, k, v, fresh=False):
+		ent = self.d.get(k)
+		if ent is not None:
+			flags = DIRTY | (ent[1] & FRESH)
+		elif fresh:
+			flags = DIRTY | FRESH
+		else:
+			flags = DIRTY
+		self._set(k, v, flags)
+
+	def Delete(self, k):
+		ent = self.d.get(k)
+		if ent is not None and (ent[1] & FRESH):
+			# created since the last flush: never needs to reach disk
+			self._drop(k)
+			return
+		self._set(k, None, DIRTY)
+
+	def prefetch(self, keys):
+		# load many keys at once, reading the misses in key order
+		# so the database sees one forward pass.  returns a dict of
+		# key -> value, or None if absent.
+		r = {}
+		for k in sorted(keys):
+			ent = self.d.get(k)
+			if ent is not None:
+				self.hits += 1
+			else:
+				self.misses += 1
+				try:
+					ent = [self.db.Get(k), 0]
+				except KeyError:
+					ent = [None, FRESH]
+				self._set(k, ent[0], ent[1])
+			r[k] = ent[0]
+		return r
+
+	def full(self):
+		return self.bytes > self.max_bytes
+
+	def flush(self, sync=False):
+		# write all changes in one atomic batch.  the entries stay
+		# cached, now clean, unless the cache is over its budget.
+		n_written = self.n_dirty
+		if n_written > 0:
+			batch = leveldb.WriteBatch()
+			for k, ent in self.d.iteritems():
+				if not (ent[1] & DIRTY):
+					continue
+				if ent[0] is None:
+					batch.Delete(k)
+				else:
+					batch.Put(k, ent[0])
+			self.db.Write(batch, sync=sync)
+			self.flushes += 1
+
+		if self.full():
+			self.d = {}
+			self.bytes = 0
+		elif n_written > 0:
+			for ent in self.d.itervalues():
+				# deleted keys are now absent from disk
+				if ent[0] is None:
+					ent[1] = FRESH
+				else:
+					ent[1] = 0
+		self.n_dirty = 0
+		return n_written
+
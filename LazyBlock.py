@@ -0,0 +1,132 @@
+#
+# LazyBlock.py - block that decodes its transactions on first use
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import struct
+import cStringIO
+from bitcoin.serialize import uint256_from_str, uint256_from_compact, Hash
+from bitcoin.core import CBlock, CTransaction
+
+HDR_FIELDS = frozenset(('nVersion', 'hashPrevBlock', 'hashMerkleRoot',
+			'nTime', 'nBits', 'nNonce', 'vtx'))
+
+
+class LazyBlock(CBlock):
+	def __init__(self, raw, blkhash=None):
+		CBlock.__init__(self)
+
+		(self.nVersion, prevhash, merkle, self.nTime, self.nBits,
+		 self.nNonce) = struct.unpack("<i32s32sIII", raw[:80])
+		self.hashPrevBlock = uint256_from_str(prevhash)
+		self.hashMerkleRoot = uint256_from_str(merkle)
+
+		# set last: assigning header fields or vtx drops the raw
+		# buffer, as it no longer matches the block
+		self._vtx = None
+		self.txpos = None
+		self.txhashes = None	# tx hashes, if computed elsewhere
+		self.checked = False	# is_valid() already passed elsewhere
+		self.raw = raw
+		self.sha256 = blkhash	# when the caller already knows it
+
+	def __setattr__(self, name, value):
+		if name in HDR_FIELDS:
+			object.__setattr__(self, 'raw', None)
+			object.__setattr__(self, 'checked', False)
+			if name != 'vtx':
+				object.__setattr__(self, 'sha256', None)
+		object.__setattr__(self, name, value)
+
+	def get_vtx(self):
+		if self._vtx is None:
+			self.decode_vtx()
+		return self._vtx
+
+	def set_vtx(self, vtx):
+		object.__setattr__(self, '_vtx', vtx)
+
+	vtx = property(get_vtx, set_vtx)
+
+	def ntx_pos(self):
+		# tx count and offset of the first tx, without decoding
+		n = ord(self.raw[80])
+		if n < 253:
+			return (n, 81)
+		elif n == 253:
+			return (struct.unpack("<H", self.raw[81:83])[0], 83)
+		elif n == 254:
+			return (struct.unpack("<I", self.raw[81:85])[0], 85)
+		return (struct.unpack("<Q", self.raw[81:89])[0], 89)
+
+	def ntx(self):
+		if self._vtx is not None or self.raw is None:
+			return len(self.vtx)
+		return self.ntx_pos()[0]
+
+	def decode_vtx(self):
+		(n, pos) = self.ntx_pos()
+		f = cStringIO.StringIO(self.raw)
+		f.seek(pos)
+
+		vtx = []
+		txpos = []
+		for i in xrange(n):
+			tx = CTransaction()
+			tx.deserialize(f)
+			end = f.tell()
+			# hash the bytes in hand, rather than re-serializing
+			if self.txhashes is not None:
+				tx.sha256 = self.txhashes[i]
+			else:
+				tx.sha256 = uint256_from_str(Hash(self.raw[pos:end]))
+			txpos.append((pos, end - pos))
+			pos = end
+			vtx.append(tx)
+
+		# drop trailing bytes, so serialize() matches the block
+		if pos < len(self.raw):
+			object.__setattr__(self, 'raw', self.raw[:pos])
+
+		object.__setattr__(self, '_vtx', vtx)
+		object.__setattr__(self, 'txpos', txpos)
+
+	def calc_sha256(self):
+		if self.sha256 is None:
+			if self.raw is not None:
+				self.sha256 = uint256_from_str(Hash(self.raw[:80]))
+			else:
+				CBlock.calc_sha256(self)
+
+	def is_valid(self):
+		# as CBlock.is_valid, but keeping the tx hashes already known
+		if self.checked:
+			return True
+		self.calc_sha256()
+		if self.sha256 > uint256_from_compact(self.nBits):
+			return False
+		for tx in self.vtx:
+			if not tx.is_valid():
+				return False
+		if self.calc_merkle() != self.hashMerkleRoot:
+			return False
+		return True
+
+	def header(self):
+		# plain header-only block, e.g. for a "headers" message
+		block = CBlock()
+		block.nVersion = self.nVersion
+		block.hashPrevBlock = self.hashPrevBlock
+		block.hashMerkleRoot = self.hashMerkleRoot
+		block.nTime = self.nTime
+		block.nBits = self.nBits
+		block.nNonce = self.nNonce
+		return block
+
+	def serialize(self):
+		if self.raw is not None:
+			return str(self.raw)
+		return CBlock.serialize(self)
+
@@ -0,0 +1,89 @@
+#
+# OrphanPool.py - blocks waiting for their parent, bounded in size and age
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import time
+from collections import OrderedDict
+
+
+class OrphanPool(object):
+	def __init__(self, max_bytes, max_age):
+		self.max_bytes = max_bytes
+		self.max_age = max_age
+		self.blocks = OrderedDict()	# hash -> (block, size, time, peer)
+		self.children = {}		# prevhash -> [hash, ...]
+		self.by_peer = {}		# peer -> OrderedDict of hash
+		self.peer_bytes = {}
+		self.bytes = 0
+		self.n_expired = 0
+		self.n_evicted = 0
+
+	def __len__(self):
+		return len(self.blocks)
+
+	def __contains__(self, blkhash):
+		return blkhash in self.blocks
+
+	def add(self, block, size, peer=None):
+		if block.sha256 in self.blocks:
+			return False
+		now = time.time()
+		self.expire(now)
+
+		self.blocks[block.sha256] = (block, size, now, peer)
+		self.children.setdefault(block.hashPrevBlock, []).append(block.sha256)
+		self.by_peer.setdefault(peer, OrderedDict())[block.sha256] = True
+		self.peer_bytes[peer] = self.peer_bytes.get(peer, 0) + size
+		self.bytes += size
+
+		# make room at the expense of whichever peer holds the most,
+		# so one peer flooding orphans only displaces its own
+		while self.bytes > self.max_bytes and len(self.blocks) > 1:
+			peer = max(self.peer_bytes, key=self.peer_bytes.get)
+			blkhash = iter(self.by_peer[peer]).next()
+			self.remove(blkhash)
+			self.n_evicted += 1
+		return True
+
+	def remove(self, blkhash):
+		(block, size, t, peer) = self.blocks.pop(blkhash)
+
+		l = self.children[block.hashPrevBlock]
+		l.remove(blkhash)
+		if not l:
+			del self.children[block.hashPrevBlock]
+
+		del self.by_peer[peer][blkhash]
+		self.peer_bytes[peer] -= size
+		if not self.by_peer[peer]:
+			del self.by_peer[peer]
+			del self.peer_bytes[peer]
+
+		self.bytes -= size
+		return block
+
+	def expire(self, now):
+		# blocks are held in arrival order, oldest first
+		while self.blocks:
+			blkhash = iter(self.blocks).next()
+			if now - self.blocks[blkhash][2] < self.max_age:
+				break
+			self.remove(blkhash)
+			self.n_expired += 1
+
+	def pop_children(self, blkhash):
+		# remove and return every orphan whose parent is blkhash
+		return [self.remove(h) for h in list(self.children.get(blkhash, []))]
+
+	def stats(self):
+		return {
+			'count' : len(self.blocks),
+			'bytes' : self.bytes,
+			'peers' : len(self.by_peer),
+			'expired' : self.n_expired,
+			'evicted' : self.n_evicted,
+		}
+
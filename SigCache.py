@@ -0,0 +1,46 @@
+#
+# SigCache.py - signature checks already known to pass
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import random
+
+
+class SigCache(object):
+	# bounded set of (txid, input index, flags) that verified; when
+	# full, a random entry makes room, which cannot be steered by
+	# a peer the way oldest-first eviction can
+	def __init__(self, max=50000):
+		self.max = max
+		self.d = {}		# key -> index in self.l
+		self.l = []
+		self.hits = 0
+		self.misses = 0
+
+	def contains(self, txhash, n, flags):
+		if (txhash, n, flags) in self.d:
+			self.hits += 1
+			return True
+		self.misses += 1
+		return False
+
+	def add(self, txhash, n, flags):
+		k = (txhash, n, flags)
+		if self.max <= 0 or k in self.d:
+			return
+		if len(self.l) >= self.max:
+			self.evict(random.randrange(len(self.l)))
+		self.d[k] = len(self.l)
+		self.l.append(k)
+
+	def evict(self, i):
+		# move the last key into slot i, keeping removal O(1)
+		k = self.l[i]
+		last = self.l.pop()
+		if last != k:
+			self.l[i] = last
+			self.d[last] = i
+		del self.d[k]
+
@@ -0,0 +1,133 @@
+#
+# SigVerifier.py - script signature checks, spread over worker processes
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import Queue
+import cStringIO
+import multiprocessing
+
+from bitcoin.core import CTransaction
+from bitcoin.scripteval import VerifySignature
+
+
+def deser_tx(s):
+	tx = CTransaction()
+	tx.deserialize(cStringIO.StringIO(s))
+	return tx
+
+def verify_worker(jobs, results, abort):
+	while True:
+		job = jobs.get()
+		if job is None:
+			return
+
+		# job: (generation, index, tx, [(input index, txfrom), ...])
+		(gen, idx, ser_tx, inputs) = job
+		bad = None
+		err = None
+		if abort.value != gen:
+			i = -1
+			try:
+				tx = deser_tx(ser_tx)
+				for (i, ser_txfrom) in inputs:
+					# matched to the input by hash when
+					# queued, and may be just the spent
+					# output of a pruned tx
+					txfrom = deser_tx(ser_txfrom)
+					txfrom.sha256 = tx.vin[i].prevout.hash
+					if not VerifySignature(txfrom, tx, i, 0):
+						bad = i
+						break
+			except Exception, e:
+				# a check that raises fails, but says
+				# nothing about the block
+				bad = i
+				err = "%s: %s" % (e.__class__.__name__, e)
+
+		results.put((gen, idx, bad, err))
+
+
+class SigVerifier(object):
+	def __init__(self, nproc, idle=None):
+		self.nproc = nproc
+		self.gen = 0
+		self.procs = []
+
+		# called while waiting on the workers, so an event loop
+		# can run; without it, verify() blocks until done
+		self.idle = idle
+		if nproc <= 1:
+			return		# verify in-process
+
+		# the job queue is bounded, so a large block is fed to the
+		# workers as they free up rather than copied in all at once
+		self.jobs = multiprocessing.Queue(nproc * 4)
+		self.results = multiprocessing.Queue()
+		self.abort = multiprocessing.Value('i', 0)
+		for i in xrange(nproc):
+			p = multiprocessing.Process(target=verify_worker,
+				args=(self.jobs, self.results, self.abort))
+			p.daemon = True
+			p.start()
+			self.procs.append(p)
+
+	def verify(self, checks):
+		# checks: [(tx, [(input index, txfrom), ...]), ...]
+		# returns None if all verify, else (tx, input index, error) of
+		# a failure.  error is None for an invalid signature, or why
+		# the check could not be run.
+		if not self.procs:
+			for (tx, inputs) in checks:
+				for (i, txfrom) in inputs:
+					if not VerifySignature(txfrom, tx, i, 0):
+						return (tx, i, None)
+			return None
+
+		self.gen += 1
+		gen = self.gen
+		n_sent = 0
+		n_done = 0
+		failed = None
+		while n_done < n_sent or (failed is None and
+					  n_sent < len(checks)):
+			while failed is None and n_sent < len(checks):
+				(tx, inputs) = checks[n_sent]
+				job = (gen, n_sent, tx.serialize(),
+				       [(i, txfrom.serialize())
+					for (i, txfrom) in inputs])
+				try:
+					self.jobs.put_nowait(job)
+				except Queue.Full:
+					break
+				n_sent += 1
+
+			if self.idle is None:
+				r = self.results.get()
+			else:
+				try:
+					r = self.results.get_nowait()
+				except Queue.Empty:
+					self.idle()
+					continue
+			(rgen, idx, bad, err) = r
+			if rgen != gen:
+				continue
+			n_done += 1
+			if bad is not None and failed is None:
+				# fail fast: workers skip the rest of the
+				# queued jobs, which are then just drained
+				failed = (checks[idx][0], bad, err)
+				self.abort.value = gen
+
+		return failed
+
+	def close(self):
+		for p in self.procs:
+			self.jobs.put(None)
+		for p in self.procs:
+			p.join()
+		self.procs = []
+
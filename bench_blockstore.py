@@ -0,0 +1,122 @@
+#!/usr/bin/python
+#
+# bench_blockstore.py - disk footprint and read/write speed of block
+# records, stored as "block" messages and zlib compressed
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+
+import os
+import sys
+import time
+import mmap
+import zlib
+import struct
+import shutil
+import hashlib
+import tempfile
+import argparse
+
+from BlockStore import BlockStore
+from ChainDb import MSG_HDR_SIZE
+
+
+def read_blocks(filename, max_blocks):
+	# serialized blocks from a bootstrap.dat file: each is the
+	# network magic and a 4-byte length, then the block.  (this
+	# node's blkNNNNN.dat segments are not in that format.)
+	f = open(filename, 'rb')
+	mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	f.close()
+
+	magic = mm[:4]
+	l = []
+	pos = 0
+	while pos + 8 <= len(mm) and len(l) < max_blocks:
+		if mm[pos:pos+4] != magic:
+			pos = mm.find(magic, pos + 1)
+			if pos < 0:
+				break
+			continue
+		size = struct.unpack("<i", mm[pos+4:pos+8])[0]
+		if pos + 8 + size > len(mm):
+			break
+		l.append(mm[pos+8:pos+8+size])
+		pos += 8 + size
+	return (magic, l)
+
+def msg_record(magic, ser_block):
+	# the uncompressed record: "block" msg envelope, then the block
+	cksum = hashlib.sha256(hashlib.sha256(ser_block).digest()).digest()
+	return (magic + "block" + "\0" * 7 +
+		struct.pack("<I", len(ser_block)) + cksum[:4] + ser_block)
+
+def run(magic, blocks, level):
+	datadir = tempfile.mkdtemp(prefix='bench_blockstore')
+	try:
+		store = BlockStore(datadir)
+		recs = []
+		start = time.time()
+		for ser_block in blocks:
+			# as putoneblock: compressed only if that is smaller
+			rec = None
+			if level > 0:
+				rec = zlib.compress(ser_block, level)
+				if len(rec) >= len(ser_block) + MSG_HDR_SIZE:
+					rec = None
+			compressed = rec is not None
+			if not compressed:
+				rec = msg_record(magic, ser_block)
+			recs.append((store.write(rec), len(rec), compressed))
+		store.finish_file()
+		t_write = time.time() - start
+
+		disk = 0
+		for fn in os.listdir(datadir):
+			disk += os.path.getsize(os.path.join(datadir, fn))
+
+		# read back, as getblock_raw does
+		start = time.time()
+		n = 0
+		for ((nFile, pos), size, compressed) in recs:
+			if compressed:
+				n += len(zlib.decompress(store.view(nFile, pos, size)))
+			else:
+				n += len(str(store.view(nFile, pos + MSG_HDR_SIZE,
+							size - MSG_HDR_SIZE)))
+		t_read = time.time() - start
+		store.close()
+		return (disk, t_write, t_read, n)
+	finally:
+		shutil.rmtree(datadir, True)
+
+opts = argparse.ArgumentParser(description='Compare compressed and uncompressed block storage')
+opts.add_argument('blockfile', help='bootstrap.dat to take blocks from')
+opts.add_argument('--blocks', type=int, default=10000,
+		  help='number of blocks to use (default: 10000)')
+opts.add_argument('--levels', default='0,1,6,9',
+		  help='zlib levels to compare, 0 for uncompressed (default: 0,1,6,9)')
+args = opts.parse_args()
+
+(magic, blocks) = read_blocks(args.blockfile, args.blocks)
+total = sum(len(b) for b in blocks)
+if not blocks:
+	print "No blocks in %s" % (args.blockfile,)
+	sys.exit(1)
+print "%d blocks, %.1f MB of block data" % (len(blocks), total / 1e6)
+print "(reads are from the page cache; a cold read moves the disk bytes)"
+
+for level in [int(s) for s in args.levels.split(',')]:
+	(disk, t_write, t_read, n) = run(magic, blocks, level)
+	if n != total:
+		raise RuntimeError("read back %d bytes, expected %d" % (n, total))
+	if level > 0:
+		name = "zlib %d" % (level,)
+	else:
+		name = "msg"
+	print "%-8s %8.1f MB on disk (%5.1f%%), write %7.1f MB/s, read %7.1f MB/s" % (
+		name, disk / 1e6, 100.0 * disk / total,
+		total / 1e6 / max(t_write, 1e-6),
+		total / 1e6 / max(t_read, 1e-6))
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+#
+# bench_hashing.py - count double-SHA256 calls and tx re-serializations
+# made while handling one large block, with CBlock and with LazyBlock
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+
+import sys
+import time
+import cStringIO
+import argparse
+
+import bitcoin.core
+import LazyBlock
+from bitcoin.core import CBlock, CTransaction, CTxIn, CTxOut
+from bitcoin.serialize import *
+
+# count every double-SHA256, wherever it is called from
+n_hash = [0]
+real_hash = Hash
+
+def counting_hash(s):
+	n_hash[0] += 1
+	return real_hash(s)
+
+bitcoin.core.Hash = counting_hash
+LazyBlock.Hash = counting_hash
+
+# and every tx serialization, which hashing a decoded tx needs
+n_ser = [0]
+real_ser_tx = CTransaction.serialize
+
+def counting_ser_tx(self):
+	n_ser[0] += 1
+	return real_ser_tx(self)
+
+def mkblock(ntx):
+	# coinbase, then a chain of txs each spending the one before it
+	coinbase = CTransaction()
+	txin = CTxIn()
+	txin.prevout.set_null()
+	txin.scriptSig = "\x04bench"
+	coinbase.vin.append(txin)
+	txout = CTxOut()
+	txout.nValue = 50 * 100000000
+	txout.scriptPubKey = "\x51"
+	coinbase.vout.append(txout)
+	coinbase.calc_sha256()
+
+	block = CBlock()
+	block.nTime = 1356000000
+	block.nBits = 0x207fffff
+	block.vtx.append(coinbase)
+	prev = coinbase
+	for i in xrange(ntx - 1):
+		tx = CTransaction()
+		txin = CTxIn()
+		txin.prevout.hash = prev.sha256
+		txin.prevout.n = 0
+		txin.scriptSig = "\x51"
+		tx.vin.append(txin)
+		txout = CTxOut()
+		txout.nValue = prev.vout[0].nValue - 1000
+		txout.scriptPubKey = "\x51"
+		tx.vout.append(txout)
+		tx.calc_sha256()
+		block.vtx.append(tx)
+		prev = tx
+	block.hashMerkleRoot = block.calc_merkle()
+
+	target = uint256_from_compact(block.nBits)
+	block.calc_sha256()
+	while block.sha256 > target:
+		block.nNonce += 1
+		block.sha256 = None
+		block.calc_sha256()
+	return block.serialize()
+
+def handle_block(raw, lazy):
+	# the hashing a block sees on its way through the node: receive
+	# and validate, connect, then read back from disk to disconnect
+	if lazy:
+		block = LazyBlock.LazyBlock(raw)
+		block.decode_vtx()
+	else:
+		block = CBlock()
+		block.deserialize(cStringIO.StringIO(raw))
+
+	block.calc_sha256()
+	if not block.is_valid():
+		raise RuntimeError("benchmark block is invalid")
+
+	# connect_block: tx index, then in-block input lookups as the
+	# signature check did them (a scan of the block per input)
+	for tx in block.vtx:
+		tx.calc_sha256()
+	if lazy:
+		blktxs = {}
+		for tx in block.vtx:
+			tx.calc_sha256()
+			blktxs[tx.sha256] = tx
+		for tx in block.vtx[1:]:
+			blktxs.get(tx.vin[0].prevout.hash)
+	else:
+		for tx in block.vtx[1:]:
+			for blktx in block.vtx:
+				blktx.calc_sha256()
+				if blktx.sha256 == tx.vin[0].prevout.hash:
+					break
+
+	# disconnect: the block is read back from disk
+	blkhash = block.sha256
+	if lazy:
+		block = LazyBlock.LazyBlock(raw, blkhash)
+	else:
+		block = CBlock()
+		block.deserialize(cStringIO.StringIO(raw))
+		block.calc_sha256()
+	for tx in block.vtx:
+		tx.calc_sha256()
+
+def run(raw, lazy):
+	n_hash[0] = 0
+	n_ser[0] = 0
+	CTransaction.serialize = counting_ser_tx
+	start = time.time()
+	handle_block(raw, lazy)
+	t = time.time() - start
+	CTransaction.serialize = real_ser_tx
+	return (n_hash[0], n_ser[0], t)
+
+opts = argparse.ArgumentParser(description='Count block hashing work')
+opts.add_argument('--ntx', type=int, default=2000,
+		  help='transactions in the test block (default: 2000)')
+args = opts.parse_args()
+
+raw = mkblock(args.ntx)
+(n_old, ser_old, t_old) = run(raw, False)
+(n_new, ser_new, t_new) = run(raw, True)
+
+print "%d-tx block, %d bytes" % (args.ntx, len(raw))
+print "CBlock:    %6d double-SHA256, %6d tx serializations, %.3fs" % (
+	n_old, ser_old, t_old)
+print "LazyBlock: %6d double-SHA256, %6d tx serializations, %.3fs" % (
+	n_new, ser_new, t_new)
+print "removed:   %6d double-SHA256, %6d tx serializations" % (
+	n_old - n_new, ser_old - ser_new)
@@ -8,6 +8,7 @@
 
 
 import sys
+import os
 import Log
 import MemPool
 import ChainDb
@@ -15,6 +16,7 @@ import cStringIO
 
 from bitcoin.coredefs import NETWORKS
 from bitcoin.core import CBlock
+from bitcoin.serialize import uint256_from_str
 from bitcoin.scripteval import *
 
 NET_SETTINGS = {
@@ -34,23 +36,51 @@ SETTINGS = NET_SETTINGS[MY_NETWORK]
 
 log = Log.Log(SETTINGS['log'])
 mempool = MemPool.MemPool(log)
-chaindb = ChainDb.ChainDb(SETTINGS['db'], log, mempool, NETWORKS[MY_NETWORK])
+chaindb = ChainDb.ChainDb(SETTINGS, SETTINGS['db'], log, mempool,
+			  NETWORKS[MY_NETWORK], True)
 
 scanned = 0
 failures = 0
 
-for height in xrange(chaindb.getheight()):
-	heightidx = ChainDb.HeightIdx()
-	heightidx.deserialize(chaindb.height[str(height)])
+# every block index entry must lie within an existing segment file
+seg_size = {}
+seg_blocks = {}
+pruned = 0
+for k, v in chaindb.db.RangeIter('blocks:', 'blocks:' + ('\xff' * 32)):
+	blkpos = ChainDb.BlkPos()
+	blkpos.deserialize(v)
+	if blkpos.flags & ChainDb.BLKPOS_PRUNED:
+		pruned += 1
+		continue
+
+	if blkpos.nFile not in seg_size:
+		try:
+			seg_size[blkpos.nFile] = os.path.getsize(
+				chaindb.blkstore.filename(blkpos.nFile))
+		except OSError:
+			seg_size[blkpos.nFile] = -1
+		seg_blocks[blkpos.nFile] = 0
+
+	seg_blocks[blkpos.nFile] += 1
+	if blkpos.pos + blkpos.size > seg_size[blkpos.nFile]:
+		log.write("block %064x: %s past end of segment" % (
+			uint256_from_str(k[7:]), repr(blkpos)))
+		failures += 1
 
-	blkhash = heightidx.blocks[0]
-	ser_hash = ser_uint256(blkhash)
+for nFile in sorted(seg_size.iterkeys()):
+	log.write("Segment %d: %d blocks, %d bytes" % (
+		nFile, seg_blocks[nFile], seg_size[nFile]))
+if pruned:
+	log.write("%d blocks pruned" % (pruned,))
 
-	f = cStringIO.StringIO(chaindb.blocks[ser_hash])
-	block = CBlock()
-	block.deserialize(f)
+# main chain blocks must decode and validate
+for height in xrange(chaindb.getheight()+1):
+	blkhash = chaindb.getblockhash(height)
+	if chaindb.ispruned(blkhash):
+		continue
+	block = chaindb.getblock(blkhash)
 
-	if not block.is_valid():
+	if block is None or not block.is_valid():
 		log.write("block %064x failed" % (blkhash,))
 		failures += 1
 
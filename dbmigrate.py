@@ -0,0 +1,466 @@
+#!/usr/bin/python
+#
+# dbmigrate.py - upgrade a chain database to the current schema, in place
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+
+import sys
+import os
+import io
+import zlib
+import struct
+import argparse
+import binascii
+import leveldb
+import Log
+import ChainDb
+from Cache import Cache
+
+from bitcoin.coredefs import NETWORKS
+from bitcoin.serialize import *
+from bitcoin.messages import message_read
+
+BATCH_SIZE = 10000
+
+
+def ser_bitmask(mask):
+	if mask == 0:
+		return chr(0)
+	h = '%x' % (mask,)
+	if len(h) & 1:
+		h = '0' + h
+	r = binascii.unhexlify(h)[::-1]	# little-endian
+	return ChainDb.ser_compact_size(len(r)) + r
+
+def deser_bitmask(s, pos=0):
+	(n, pos) = ChainDb.deser_compact_size(s, pos)
+	if n == 0:
+		return (0L, pos)
+	r = s[pos:pos+n]
+	return (long(binascii.hexlify(r[::-1]), 16), pos + n)
+
+def getnetmagic(db):
+	msg_start = db.Get('misc:msg_start')
+	for netmagic in NETWORKS.itervalues():
+		if netmagic.msg_start == msg_start:
+			return netmagic
+	raise RuntimeError("unknown network magic %s" % (repr(msg_start),))
+
+class BlockReader(object):
+	def __init__(self, datadir, db):
+		self.db = db
+		self.netmagic = getnetmagic(db)
+		self.f = io.BufferedReader(io.FileIO(datadir + '/blocks.dat', 'rb'))
+		self.cache = Cache(100)
+
+	def getblock(self, blkhash):
+		block = self.cache.get(blkhash)
+		if block is not None:
+			return block
+
+		fpos = long(self.db.Get('blocks:'+ser_uint256(blkhash)))
+		self.f.seek(fpos)
+		block = message_read(self.netmagic, self.f).block
+		for tx in block.vtx:
+			tx.calc_sha256()
+
+		self.cache.put(blkhash, block)
+		return block
+
+	def gettx(self, blkhash, txhash):
+		for tx in self.getblock(blkhash).vtx:
+			if tx.sha256 == txhash:
+				return tx
+		return None
+
+
+def resume_key(db, schema, key_from):
+	# batches are committed as a migration goes.  after an
+	# interruption, carry on past the last key committed, as
+	# records before it are already in the new format.
+	try:
+		l = db.Get('misc:migrate').split()
+	except KeyError:
+		return key_from
+	if int(l[0]) != schema:
+		return key_from
+	return max(key_from, binascii.unhexlify(l[1]) + '\0')
+
+def mark_progress(batch, schema, k):
+	batch.Put('misc:migrate', "%d %s" % (schema, binascii.hexlify(k)))
+
+# v0 -> v1: text "hex(blkhash) hex(spentmask)" tx: records become binary TxIdx
+def migrate_v1(datadir, db, log):
+	batch = leveldb.WriteBatch()
+	n_batch = 0
+	n_total = 0
+	bytes_old = 0
+	bytes_new = 0
+
+	for k, v in db.RangeIter(resume_key(db, 1, 'tx:'),
+				 'tx:' + ('\xff' * 32)):
+		l = v.split()
+		if len(l) != 2:
+			log.write("Skipping malformed tx index record %s" % (repr(v),))
+			continue
+
+		ser_txidx = (ser_uint256(long(l[0], 16)) +
+			     ser_bitmask(long(l[1], 16)))
+		batch.Put(k, ser_txidx)
+
+		bytes_old += len(v)
+		bytes_new += len(ser_txidx)
+		n_batch += 1
+		n_total += 1
+		if n_batch >= BATCH_SIZE:
+			mark_progress(batch, 1, k)
+			db.Write(batch)
+			batch = leveldb.WriteBatch()
+			n_batch = 0
+			log.write("Rewrote %d tx index records" % (n_total,))
+
+	batch.Put('misc:schema', str(1))
+	batch.Delete('misc:migrate')
+	db.Write(batch)
+
+	log.write("Rewrote %d tx index records, %d -> %d bytes" % (
+		n_total, bytes_old, bytes_new))
+
+# v1 -> v2: per-tx spent bitmask becomes one utxo: record per unspent output
+def migrate_v2(datadir, db, log):
+	blocks = BlockReader(datadir, db)
+	batch = leveldb.WriteBatch()
+	n_batch = 0
+	n_total = 0
+	n_utxo = 0
+
+	for k, v in db.RangeIter(resume_key(db, 2, 'tx:'),
+				 'tx:' + ('\xff' * 32)):
+		txhash = uint256_from_str(k[3:])
+		blkhash = uint256_from_str(v[:32])
+		spentmask = deser_bitmask(v, 32)[0]
+
+		tx = blocks.gettx(blkhash, txhash)
+		if tx is None:
+			log.write("Missing TX %064x in block %064x" % (txhash, blkhash))
+			continue
+
+		for n_idx in xrange(len(tx.vout)):
+			if spentmask & (1L << n_idx):
+				continue
+			txout = tx.vout[n_idx]
+			utxo = ChainDb.Utxo(txout.nValue, txout.scriptPubKey)
+			batch.Put(ChainDb.utxo_key(txhash, n_idx),
+				  utxo.serialize())
+			n_utxo += 1
+
+		batch.Put(k, ser_uint256(blkhash))
+
+		n_batch += 1
+		n_total += 1
+		if n_batch >= BATCH_SIZE:
+			mark_progress(batch, 2, k)
+			db.Write(batch)
+			batch = leveldb.WriteBatch()
+			n_batch = 0
+			log.write("Converted %d transactions, %d unspent outputs" % (n_total, n_utxo))
+
+	batch.Put('misc:schema', str(2))
+	batch.Delete('misc:migrate')
+	db.Write(batch)
+
+	log.write("Converted %d transactions, %d unspent outputs" % (n_total, n_utxo))
+
+# v2 -> v3: tx: records gain the tx position and length within blocks.dat
+def migrate_v3(datadir, db, log):
+	blocks = BlockReader(datadir, db)
+	batch = leveldb.WriteBatch()
+	n_batch = 0
+	n_total = 0
+
+	for k, v in db.RangeIter(resume_key(db, 3, 'blocks:'),
+				 'blocks:' + ('\xff' * 32)):
+		blkhash = uint256_from_str(k[7:])
+		block = blocks.getblock(blkhash)
+		txpos = ChainDb.tx_positions(block, ChainDb.BlkPos(0, long(v)))
+
+		for i in xrange(len(block.vtx)):
+			ser_txhash = ser_uint256(block.vtx[i].sha256)
+			try:
+				old = db.Get('tx:'+ser_txhash)
+			except KeyError:
+				continue	# side chain block
+			if uint256_from_str(old[:32]) != blkhash:
+				continue	# duplicate txid, indexed elsewhere
+
+			batch.Put('tx:'+ser_txhash, ser_uint256(blkhash) +
+				  ChainDb.ser_compact_size(txpos[i][0]) +
+				  ChainDb.ser_compact_size(txpos[i][1]))
+			n_batch += 1
+			n_total += 1
+
+		if n_batch >= BATCH_SIZE:
+			mark_progress(batch, 3, k)
+			db.Write(batch)
+			batch = leveldb.WriteBatch()
+			n_batch = 0
+			log.write("Located %d transactions" % (n_total,))
+
+	batch.Put('misc:schema', str(3))
+	batch.Delete('misc:migrate')
+	db.Write(batch)
+
+	log.write("Located %d transactions" % (n_total,))
+
+# v3 -> v4: blocks.dat becomes segment blk00000.dat; blocks: and tx:
+# records carry a file number, and blocks: also the record length
+def migrate_v4(datadir, db, log):
+	old_fn = datadir + '/blocks.dat'
+	new_fn = datadir + '/blk00000.dat'
+	if os.path.exists(old_fn):
+		os.rename(old_fn, new_fn)
+	f = io.FileIO(new_fn, 'rb')
+
+	batch = leveldb.WriteBatch()
+	n_batch = 0
+	n_blocks = 0
+	n_txs = 0
+
+	for k, v in db.RangeIter(resume_key(db, 4, 'blocks:'),
+				 'blocks:' + ('\xff' * 32)):
+		fpos = long(v)
+		f.seek(fpos + 4 + 12)
+		msglen = struct.unpack("<i", f.read(4))[0]
+
+		blkpos = ChainDb.BlkPos(0, fpos, ChainDb.MSG_HDR_SIZE + msglen)
+		batch.Put(k, blkpos.serialize())
+
+		n_batch += 1
+		n_blocks += 1
+		if n_batch >= BATCH_SIZE:
+			mark_progress(batch, 4, k)
+			db.Write(batch)
+			batch = leveldb.WriteBatch()
+			n_batch = 0
+			log.write("Rewrote %d block index records" % (n_blocks,))
+
+	for k, v in db.RangeIter(resume_key(db, 4, 'tx:'),
+				 'tx:' + ('\xff' * 32)):
+		blkhash = uint256_from_str(v[:32])
+		(pos, i) = ChainDb.deser_compact_size(v, 32)
+		size = ChainDb.deser_compact_size(v, i)[0]
+
+		txidx = ChainDb.TxIdx(blkhash, 0, pos, size)
+		batch.Put(k, txidx.serialize())
+
+		n_batch += 1
+		n_txs += 1
+		if n_batch >= BATCH_SIZE:
+			mark_progress(batch, 4, k)
+			db.Write(batch)
+			batch = leveldb.WriteBatch()
+			n_batch = 0
+			log.write("Rewrote %d tx index records" % (n_txs,))
+
+	batch.Put('misc:blkfile', "0 %d" % (os.fstat(f.fileno()).st_size,))
+	batch.Put('misc:schema', str(4))
+	batch.Delete('misc:migrate')
+	db.Write(batch)
+	f.close()
+
+	log.write("Rewrote %d block and %d tx index records" % (n_blocks, n_txs))
+
+# v4 -> v5: blkmeta: records gain the previous block hash
+def migrate_v5(datadir, db, log):
+	files = {}
+	batch = leveldb.WriteBatch()
+	n_batch = 0
+	n_total = 0
+
+	for k, v in db.RangeIter(resume_key(db, 5, 'blocks:'),
+				 'blocks:' + ('\xff' * 32)):
+		blkpos = ChainDb.BlkPos()
+		blkpos.deserialize(v)
+		if blkpos.nFile not in files:
+			fn = "%s/blk%05d.dat" % (datadir, blkpos.nFile)
+			files[blkpos.nFile] = io.FileIO(fn, 'rb')
+		f = files[blkpos.nFile]
+
+		# hashPrevBlock follows nVersion in the block header
+		f.seek(blkpos.pos + ChainDb.MSG_HDR_SIZE + 4)
+		prevhash = uint256_from_str(f.read(32))
+
+		meta = db.Get('blkmeta:'+k[7:]).split()
+		batch.Put('blkmeta:'+k[7:], "%s %s %s" % (meta[0], meta[1],
+							  hex(prevhash)))
+
+		n_batch += 1
+		n_total += 1
+		if n_batch >= BATCH_SIZE:
+			mark_progress(batch, 5, k)
+			db.Write(batch)
+			batch = leveldb.WriteBatch()
+			n_batch = 0
+			log.write("Rewrote %d block metadata records" % (n_total,))
+
+	batch.Put('misc:schema', str(5))
+	batch.Delete('misc:migrate')
+	db.Write(batch)
+	for f in files.itervalues():
+		f.close()
+
+	log.write("Rewrote %d block metadata records" % (n_total,))
+
+# v5 -> v6: chain work becomes the expected hash count, 2**256 / (target+1),
+# summed along the chain, in place of the sum of the targets
+def migrate_v6(datadir, db, log):
+	# each block's target is its old work less its parent's
+	metas = {}
+	for k, v in db.RangeIter('blkmeta:', 'blkmeta:' + ('\xff' * 32)):
+		meta = ChainDb.BlkMeta()
+		meta.deserialize(v)
+		metas[uint256_from_str(k[8:])] = meta
+
+	l = metas.keys()
+	l.sort(key=lambda blkhash: metas[blkhash].height)
+	old_work = {}
+	for blkhash in l:
+		meta = metas[blkhash]
+		old_work[blkhash] = meta.work
+		prev = metas.get(meta.prevhash)
+		if prev is None:
+			meta.work = (1L << 256) // (meta.work + 1)
+		else:
+			target = meta.work - old_work[meta.prevhash]
+			meta.work = prev.work + (1L << 256) // (target + 1)
+
+	# every record changes in one batch, which a rerun can repeat
+	batch = leveldb.WriteBatch()
+	for blkhash in l:
+		batch.Put('blkmeta:'+ser_uint256(blkhash),
+			  metas[blkhash].serialize())
+	try:
+		tophash = uint256_from_str(db.Get('misc:tophash'))
+		if tophash in metas:
+			batch.Put('misc:total_work', hex(metas[tophash].work))
+	except KeyError:
+		pass
+	batch.Put('misc:schema', str(6))
+	db.Write(batch)
+
+	log.write("Rewrote %d block metadata records" % (len(l),))
+
+def read_header(datadir, files, blkpos):
+	# the 80-byte header from a stored block record
+	if blkpos.nFile not in files:
+		fn = "%s/blk%05d.dat" % (datadir, blkpos.nFile)
+		try:
+			files[blkpos.nFile] = io.FileIO(fn, 'rb')
+		except IOError:
+			files[blkpos.nFile] = None
+	f = files[blkpos.nFile]
+	if f is None:
+		return None
+
+	if blkpos.flags & ChainDb.BLKPOS_ZLIB:
+		f.seek(blkpos.pos)
+		d = zlib.decompressobj()
+		try:
+			return d.decompress(f.read(min(blkpos.size, 4096)),
+					    ChainDb.BLK_HDR_SIZE)
+		except zlib.error:
+			return None
+	f.seek(blkpos.pos + ChainDb.MSG_HDR_SIZE)
+	return f.read(ChainDb.BLK_HDR_SIZE)
+
+# v6 -> v7: blkmeta: records gain status flags, taking over the failed
+# flag (4) of blocks: records, and the block header, where the block
+# data is still present
+BLKPOS_FAILED_V6 = 4
+
+def migrate_v7(datadir, db, log):
+	files = {}
+	batch = leveldb.WriteBatch()
+	n_batch = 0
+	n_total = 0
+	n_missing = 0
+
+	for k, v in db.RangeIter(resume_key(db, 7, 'blkmeta:'),
+				 'blkmeta:' + ('\xff' * 32)):
+		meta = ChainDb.BlkMeta()
+		meta.deserialize(v)
+
+		try:
+			blkpos = ChainDb.BlkPos()
+			blkpos.deserialize(db.Get('blocks:'+k[8:]))
+		except KeyError:
+			blkpos = None
+		if blkpos is not None and (blkpos.flags & BLKPOS_FAILED_V6):
+			meta.flags |= ChainDb.BLKMETA_FAILED
+			blkpos.flags &= ~BLKPOS_FAILED_V6
+			batch.Put('blocks:'+k[8:], blkpos.serialize())
+
+		hdr = None
+		if (blkpos is not None and
+		    not (blkpos.flags & ChainDb.BLKPOS_PRUNED)):
+			hdr = read_header(datadir, files, blkpos)
+		if hdr is not None and Hash(hdr) == k[8:]:
+			meta.header = hdr
+			n_total += 1
+		else:
+			n_missing += 1
+
+		batch.Put(k, meta.serialize())
+		n_batch += 1
+		if n_batch >= BATCH_SIZE:
+			mark_progress(batch, 7, k)
+			db.Write(batch)
+			batch = leveldb.WriteBatch()
+			n_batch = 0
+			log.write("Added %d block headers" % (n_total,))
+
+	batch.Put('misc:schema', str(7))
+	batch.Delete('misc:migrate')
+	db.Write(batch)
+	for f in files.itervalues():
+		if f is not None:
+			f.close()
+
+	log.write("Added %d block headers; %d blocks have no data to take one from" % (
+		n_total, n_missing))
+
+# schema version -> function upgrading the database to the next version
+MIGRATIONS = {
+	0 : migrate_v1,
+	1 : migrate_v2,
+	2 : migrate_v3,
+	3 : migrate_v4,
+	4 : migrate_v5,
+	5 : migrate_v6,
+	6 : migrate_v7,
+}
+
+opts = argparse.ArgumentParser(description='Upgrade chain database schema')
+opts.add_argument('datadir', help='database directory (the "db" setting)')
+
+args = opts.parse_args()
+
+log = Log.Log()
+
+db = leveldb.LevelDB(args.datadir + '/leveldb')
+
+schema = ChainDb.getschema(db)
+if schema > ChainDb.DB_SCHEMA:
+	log.write("Database schema %d is newer than this program (%d)" % (
+		schema, ChainDb.DB_SCHEMA))
+	sys.exit(1)
+
+while schema < ChainDb.DB_SCHEMA:
+	log.write("Migrating schema %d -> %d" % (schema, schema + 1))
+	MIGRATIONS[schema](args.datadir, db, log)
+	schema = ChainDb.getschema(db)
+
+log.write("Database is at schema version %d" % (schema,))
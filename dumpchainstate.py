@@ -0,0 +1,146 @@
+#!/usr/bin/python
+#
+# dumpchainstate.py - write a chain state snapshot, for loadchainstate.py
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+
+import sys
+import argparse
+import Log
+import MemPool
+import ChainDb
+from ChainSnapshot import SnapshotWriter
+
+from bitcoin.coredefs import NETWORKS
+from bitcoin.serialize import *
+
+PROGRESS_RECORDS = 1000000
+
+
+def rollback(chaindb, height, log):
+	# utxo changes undoing the best chain blocks above height:
+	# key -> serialized Utxo, or None if not unspent at height
+	overlay = {}
+	for h in xrange(chaindb.getheight(), height, -1):
+		blkhash = chaindb.getblockhash(h)
+		block = chaindb.getblock(blkhash)
+		try:
+			undo = ChainDb.BlkUndo()
+			undo.deserialize(chaindb.db.Get('undo:'+ser_uint256(blkhash)))
+		except KeyError:
+			undo = None
+		if block is None or undo is None:
+			log.write("Cannot roll back block %064x, height %d: no block data or undo record" % (blkhash, h))
+			return None
+
+		for tx in block.vtx:
+			tx.calc_sha256()
+			for n in xrange(len(tx.vout)):
+				overlay[ChainDb.utxo_key(tx.sha256, n)] = None
+		for (txhash, n, utxo) in undo.spent:
+			overlay[ChainDb.utxo_key(txhash, n)] = utxo.serialize()
+
+	log.write("Rolled back %d blocks, %d outputs changed" % (
+		chaindb.getheight() - height, len(overlay)))
+	return overlay
+
+def utxos_at(chaindb, overlay):
+	# the utxo: range merged with the rollback overlay, in key order
+	added = sorted(k for k, v in overlay.iteritems() if v is not None)
+	i = 0
+	for k, v in chaindb.db.RangeIter('utxo:', 'utxo:' + ('\xff' * 36)):
+		while i < len(added) and added[i] < k:
+			yield (added[i], overlay[added[i]])
+			i += 1
+		if k in overlay:
+			v = overlay[k]
+			if v is None:
+				continue
+			if i < len(added) and added[i] == k:
+				i += 1
+		yield (k, v)
+	while i < len(added):
+		yield (added[i], overlay[added[i]])
+		i += 1
+
+def dump(chaindb, height, overlay, w, log):
+	# records go out in key order, so the loader writes sequentially:
+	# blkmeta:, blocks:, misc:, then utxo:
+	for k, v in chaindb.db.RangeIter('blkmeta:', 'blkmeta:' + ('\xff' * 32)):
+		w.put(k, v)
+
+	# blocks up to height are marked pruned: their data stays behind.
+	# later ones are left to be fetched, from their headers.
+	blkpos = ChainDb.BlkPos()
+	for k, v in chaindb.db.RangeIter('blocks:', 'blocks:' + ('\xff' * 32)):
+		node = chaindb.blkindex.get(uint256_from_str(k[7:]))
+		if node is None or node.height > height:
+			continue
+		blkpos.deserialize(v)
+		blkpos.flags |= ChainDb.BLKPOS_PRUNED
+		w.put(k, blkpos.serialize())
+	log.write("Wrote block index, %d records" % (w.n_records,))
+
+	node = chaindb.chain[height]
+	misc = {
+		'misc:blkfile' : '0 0',
+		'misc:height' : str(height),
+		'misc:msg_start' : chaindb.netmagic.msg_start,
+		'misc:schema' : str(ChainDb.DB_SCHEMA),
+		'misc:tophash' : ser_uint256(node.hash),
+		'misc:total_work' : hex(node.work),
+	}
+	for k in sorted(misc.iterkeys()):
+		w.put(k, misc[k])
+
+	n_utxos = 0
+	for k, v in utxos_at(chaindb, overlay):
+		w.put(k, v)
+		n_utxos += 1
+		if (n_utxos % PROGRESS_RECORDS) == 0:
+			log.write("Wrote %d unspent outputs" % (n_utxos,))
+	log.write("Wrote %d unspent outputs" % (n_utxos,))
+
+opts = argparse.ArgumentParser(description='Write a chain state snapshot')
+opts.add_argument('datadir', help='database directory (the "db" setting)')
+opts.add_argument('outfile', help='snapshot file to write')
+opts.add_argument('--height', dest='height', type=int, default=None,
+		  help='best chain height to snapshot (default: tip)')
+opts.add_argument('--network', dest='network', default='mainnet',
+		  choices=sorted(NETWORKS.iterkeys()))
+
+args = opts.parse_args()
+
+log = Log.Log()
+
+mempool = MemPool.MemPool(log)
+chaindb = ChainDb.ChainDb({}, args.datadir, log, mempool,
+			  NETWORKS[args.network], True)
+
+height = args.height
+if height is None:
+	height = chaindb.getheight()
+if height < 0 or height > chaindb.getheight():
+	log.write("Height %d not on the best chain (tip %d)" % (
+		height, chaindb.getheight()))
+	sys.exit(1)
+
+overlay = rollback(chaindb, height, log)
+if overlay is None:
+	sys.exit(1)
+
+log.write("Writing chain state at height %d to %s" % (height, args.outfile))
+
+outf = open(args.outfile, 'wb')
+w = SnapshotWriter(outf, chaindb.netmagic.msg_start, height,
+		   chaindb.getblockhash(height))
+dump(chaindb, height, overlay, w, log)
+w.close()
+outf.close()
+chaindb.close()
+
+log.write("Wrote %d records, snapshot of block %064x" % (
+	w.n_records, chaindb.getblockhash(height)))
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+#
+# loadchainstate.py - create a chain database from a chain state snapshot
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+
+import sys
+import os
+import zlib
+import argparse
+import leveldb
+import Log
+import ChainDb
+from ChainSnapshot import SnapshotReader
+
+BATCH_SIZE = 10000
+PROGRESS_RECORDS = 1000000
+
+opts = argparse.ArgumentParser(description='Create a chain database from a chain state snapshot')
+opts.add_argument('infile', help='snapshot file, from dumpchainstate.py')
+opts.add_argument('datadir', help='new database directory (the "db" setting)')
+
+args = opts.parse_args()
+
+log = Log.Log()
+
+if os.path.exists(args.datadir + '/leveldb'):
+	log.write("%s already holds a database" % (args.datadir,))
+	sys.exit(1)
+
+inf = open(args.infile, 'rb')
+r = SnapshotReader(inf)
+log.write("Loading chain state at height %d, block %064x" % (
+	r.height, r.blkhash))
+
+if not os.path.isdir(args.datadir):
+	os.makedirs(args.datadir)
+
+# the snapshot is in key order: writes go straight to the end of the
+# database, in large batches with a large write buffer
+db = leveldb.LevelDB(args.datadir + '/leveldb',
+		     write_buffer_size=64 * 1024 * 1024)
+
+# misc: records, which make the database usable, are held back until
+# the whole snapshot has been read and its checksum verified
+misc = {}
+batch = leveldb.WriteBatch()
+n_batch = 0
+try:
+	for k, v in r.records():
+		if k.startswith('misc:'):
+			misc[k] = v
+			continue
+
+		batch.Put(k, v)
+		n_batch += 1
+		if n_batch >= BATCH_SIZE:
+			db.Write(batch)
+			batch = leveldb.WriteBatch()
+			n_batch = 0
+		if (r.n_records % PROGRESS_RECORDS) == 0:
+			log.write("Loaded %d records" % (r.n_records,))
+except (RuntimeError, zlib.error), e:
+	log.write("%s: %s.  Remove %s before trying again." % (
+		args.infile, e, args.datadir))
+	sys.exit(1)
+db.Write(batch)
+inf.close()
+
+if (misc.get('misc:schema') != str(ChainDb.DB_SCHEMA) or
+    misc.get('misc:msg_start') != r.msg_start):
+	log.write("Snapshot is not for this schema version or network")
+	sys.exit(1)
+
+batch = leveldb.WriteBatch()
+for k, v in misc.iteritems():
+	batch.Put(k, v)
+db.Write(batch, sync=True)
+
+log.write("Loaded %d records.  Block data up to height %d is marked pruned; the node syncs on from there." % (
+	r.n_records, r.height))
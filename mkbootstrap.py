@@ -64,19 +64,24 @@ scanned = 0
 failures = 0
 
 for height in xrange(scan_height+1):
-	heightidx = ChainDb.HeightIdx()
-	heightstr = str(height)
-	try:
-		heightidx.deserialize(chaindb.db.Get('height:'+heightstr))
-	except KeyError:
+	blkhash = chaindb.getblockhash(height)
+	if blkhash is None:
 		log.write("Height " + str(height) + " not found.")
 		continue
 
-	blkhash = heightidx.blocks[0]
-
-	block = chaindb.getblock(blkhash)
-
-	ser_block = block.serialize()
+	# copy the stored block straight from its segment file,
+	# without deserializing it
+	ser_block = chaindb.getblock_raw(blkhash)
+	if ser_block is None and chaindb.ispruned(blkhash):
+		# the file must be a complete chain to be imported
+		log.write("Block %064x at height %d pruned, stopping." % (
+			blkhash, height))
+		failures += 1
+		break
+	if ser_block is None:
+		log.write("Block %064x not found." % (blkhash,))
+		failures += 1
+		continue
 
 	outhdr = netmagic.msg_start
 	outhdr += struct.pack("<i", len(ser_block))
@@ -19,12 +19,12 @@ import sys
 import re
 import random
 import cStringIO
-import copy
 import re
 import hashlib
 import rpc
 
 import ChainDb
+from LazyBlock import LazyBlock
 import MemPool
 import Log
 from bitcoin.core import *
@@ -33,6 +33,12 @@ from bitcoin.messages import *
 
 MY_SUBVERSION = "/pynode:0.0.1/"
 
+# headers-first sync: peers from this version answer getheaders
+GETHEADERS_VERSION = 31800
+MAX_HEADERS = 2000		# per "headers" message
+MAX_BLOCKS_INFLIGHT = 16	# block requests outstanding per peer
+BLOCK_TIMEOUT = 60		# seconds before a block is requested again
+
 settings = {}
 debugnet = False
 
@@ -49,6 +55,7 @@ def verbose_recvmsg(message):
 	skipmsg = {
 		'tx',
 		'block',
+		'headers',
 		'inv',
 		'addr',
 	}
@@ -79,6 +86,8 @@ class NodeConn(Greenlet):
 		self.last_block_rx = time.time()
 		self.last_getblocks = 0
 		self.remote_height = -1
+		self.headers_done = False
+		self.last_progress = 0
 
 		self.hash_continue = None
 
@@ -140,10 +149,29 @@ class NodeConn(Greenlet):
 				raise ValueError("got bad checksum %s" % repr(self.recvbuf))
 			self.recvbuf = self.recvbuf[4+12+4+4+msglen:]
 
-			if command in messagemap:
+			if command == "block" and self.chaindb.pipeline is not None:
+				# parsed and checked by the pipeline workers,
+				# then stored in arrival order by connect_blocks
+				self.chaindb.pipeline.submit(msg, self.dstaddr)
+				self.last_block_rx = time.time()
+				self.block_received(uint256_from_str(Hash(msg[:80])))
+			elif command == "headers":
+				t = msg_headers(self.ver_recv)
+				t.deserialize(cStringIO.StringIO(msg))
+				self.got_message(t)
+			elif command == "block":
+				# keep the received bytes, which are stored as-is
+				# and hashed without re-serializing
+				t = msg_block()
+				t.block = LazyBlock(msg)
+				t.block.decode_vtx()
+				self.got_message(t)
+			elif command in messagemap:
 				f = cStringIO.StringIO(msg)
 				t = messagemap[command](self.ver_recv)
 				t.deserialize(f)
+				if command == "tx" and f.tell() == len(msg):
+					t.tx.sha256 = uint256_from_str(Hash(msg))
 				self.got_message(t)
 			else:
 				self.log.write("UNKNOWN COMMAND %s %s" % (command, repr(msg)))
@@ -176,12 +204,86 @@ class NodeConn(Greenlet):
 			inv.hash = self.netmagic.block0
 			gd.inv.append(inv)
 			self.send_message(gd)
+		elif self.headers_first():
+			if not self.headers_done:
+				self.send_getheaders(self.chaindb.best_header)
+			self.fetch_blocks()
 		elif our_height < self.remote_height:
 			gb = msg_getblocks(self.ver_send)
 			if our_height >= 0:
 				gb.locator.vHave.append(self.chaindb.gettophash())
 			self.send_message(gb)
 
+	def headers_first(self):
+		return (self.ver_send >= GETHEADERS_VERSION and
+			int(self.chaindb.settings.get('headersfirst', 1)) != 0)
+
+	def send_getheaders(self, node):
+		msg = msg_getheaders(self.ver_send)
+		msg.locator.vHave = self.chaindb.blkindex.locator(node)
+		self.send_message(msg)
+
+	def got_headers(self, message):
+		for hdr in message.headers:
+			if not self.chaindb.putheader(hdr):
+				self.log.write("Invalid header from %s, closing" % (self.dstaddr,))
+				self.handle_close()
+				return
+
+		best = self.chaindb.best_header
+		if len(message.headers) >= MAX_HEADERS:
+			# more to come: continue from the last one received
+			last = self.chaindb.blkindex.get(message.headers[-1].sha256)
+			self.send_getheaders(last)
+		else:
+			self.headers_done = True
+			self.log.write("Headers synced to height %d" % (best.height,))
+		self.fetch_blocks()
+
+	def block_received(self, blkhash):
+		# still skipped by fetch_blocks until stored, but no longer
+		# counted against this peer
+		inflight = self.peermgr.blocks_inflight
+		if blkhash in inflight:
+			inflight[blkhash] = (None, time.time())
+		if self.headers_first():
+			self.fetch_blocks()
+
+	def fetch_blocks(self):
+		# request the missing blocks of the best header chain, in
+		# height order, keeping a few outstanding per peer
+		inflight = self.peermgr.blocks_inflight
+		now = time.time()
+		n_mine = 0
+		for blkhash, (conn, t) in inflight.items():
+			if (self.chaindb.haveblock(blkhash, True) or
+			    now - t > BLOCK_TIMEOUT):
+				del inflight[blkhash]
+			elif conn is self:
+				n_mine += 1
+		if n_mine >= MAX_BLOCKS_INFLIGHT:
+			return
+
+		nodes = self.chaindb.blocks_to_fetch(MAX_BLOCKS_INFLIGHT - n_mine,
+						     inflight)
+		if not nodes:
+			return
+
+		msg = msg_getdata(self.ver_send)
+		for node in nodes:
+			inv = CInv()
+			inv.type = MSG_BLOCK
+			inv.hash = node.hash
+			msg.inv.append(inv)
+			inflight[node.hash] = (self, now)
+		self.send_message(msg)
+
+		if now - self.last_progress >= 10:
+			self.last_progress = now
+			self.log.write("Sync: block height %d, header height %d" % (
+				self.chaindb.getheight(),
+				self.chaindb.best_header.height))
+
 	def got_message(self, message):
 		gevent.sleep()
 
@@ -236,6 +338,11 @@ class NodeConn(Greenlet):
 					want.inv.append(i)
 				elif i.type == 2:
 					want.inv.append(i)
+					# a block we did not know of: the
+					# peer's chain has grown, so its
+					# headers are wanted again
+					if i.hash not in self.chaindb.blkindex:
+						self.headers_done = False
 			if len(want.inv):
 				self.send_message(want)
 
@@ -248,8 +355,12 @@ class NodeConn(Greenlet):
 				self.mempool.add(message.tx)
 
 		elif message.command == "block":
-			self.chaindb.putblock(message.block)
+			self.chaindb.putblock(message.block, self.dstaddr)
 			self.last_block_rx = time.time()
+			self.block_received(message.block.sha256)
+
+		elif message.command == "headers":
+			self.got_headers(message)
 
 		elif message.command == "getdata":
 			self.getdata(message)
@@ -301,7 +412,9 @@ class NodeConn(Greenlet):
 	def getdata_block(self, blkhash):
 		block = self.chaindb.getblock(blkhash)
 		if block is None:
-			return
+			if self.chaindb.ispruned(blkhash):
+				self.log.write("getdata: block %064x pruned" % (blkhash,))
+			return False
 
 		msg = msg_block()
 		msg.block = block
@@ -320,29 +433,42 @@ class NodeConn(Greenlet):
 
 			self.send_message(msg)
 
+		return True
+
 	def getdata(self, message):
 		if len(message.inv) > 50000:
 			self.handle_close()
 			return
+		# blocks we cannot send, pruned or unknown, are answered
+		# with notfound, so the peer asks someone else
+		notfound = msg_notfound()
 		for inv in message.inv:
 			if inv.type == MSG_TX:
 				self.getdata_tx(inv.hash)
 			elif inv.type == MSG_BLOCK:
-				self.getdata_block(inv.hash)
+				if not self.getdata_block(inv.hash):
+					notfound.inv.append(inv)
+		if len(notfound.inv) > 0:
+			self.send_message(notfound)
 
 	def getblocks(self, message):
-		blkmeta = self.chaindb.locate(message.locator)
-		height = blkmeta.height
-		top_height = self.getheight()
+		fork = self.chaindb.locate(message.locator)
+		if fork is None:
+			return
+		height = fork.height + 1
+		top_height = self.chaindb.getheight()
 		end_height = height + 500
 		if end_height > top_height:
 			end_height = top_height
 
 		msg = msg_inv()
 		while height <= end_height:
-			hash = long(self.chaindb.height[str(height)])
+			hash = self.chaindb.getblockhash(height)
 			if hash == message.hashstop:
 				break
+			# only advertise blocks we can send
+			if self.chaindb.ispruned(hash):
+				break
 
 			inv = CInv()
 			inv.type = MSG_BLOCK
@@ -357,24 +483,27 @@ class NodeConn(Greenlet):
 				self.hash_continue = msg.inv[-1].hash
 
 	def getheaders(self, message):
-		blkmeta = self.chaindb.locate(message.locator)
-		height = blkmeta.height
-		top_height = self.getheight()
-		end_height = height + 2000
+		fork = self.chaindb.locate(message.locator)
+		if fork is None:
+			return
+		height = fork.height + 1
+		top_height = self.chaindb.getheight()
+		end_height = height + MAX_HEADERS - 1
 		if end_height > top_height:
 			end_height = top_height
 
 		msg = msg_headers()
 		while height <= end_height:
-			blkhash = long(self.chaindb.height[str(height)])
+			blkhash = self.chaindb.getblockhash(height)
 			if blkhash == message.hashstop:
 				break
 
-			db_block = self.chaindb.getblock(blkhash)
-			block = copy.copy(db_block)
-			block.vtx = []
-
-			msg.headers.append(block)
+			# only a block index from before headers were kept
+			# can lack one
+			hdr = self.chaindb.getheader(blkhash)
+			if hdr is None:
+				break
+			msg.headers.append(hdr)
 
 			height += 1
 
@@ -390,6 +519,7 @@ class PeerManager(object):
 		self.peers = []
 		self.addrs = {}
 		self.tried = {}
+		self.blocks_inflight = {}	# hash -> (peer, time requested)
 
 	def add(self, host, port):
 		self.log.write("PeerManager: connecting to %s:%d" %
@@ -428,6 +558,25 @@ class PeerManager(object):
 		self.peers = []
 
 
+def connect_blocks(chaindb, log):
+	# ordered stage of the block pipeline: store and connect blocks
+	# as the workers finish them, without blocking other greenlets
+	pipeline = chaindb.pipeline
+	while True:
+		r = pipeline.get(False)
+		if r is None:
+			gevent.sleep(0.01)
+			continue
+
+		(peer, block) = r
+		start = time.time()
+		if block is None:
+			log.write("Dropping malformed block from %s" % (peer,))
+		else:
+			chaindb.putblock(block, peer)
+		pipeline.connect_secs += time.time() - start
+
+
 if __name__ == '__main__':
 	if len(sys.argv) != 2:
 		print("Usage: node.py CONFIG-FILE")
@@ -476,10 +625,16 @@ if __name__ == '__main__':
 	mempool = MemPool.MemPool(log)
 	chaindb = ChainDb.ChainDb(settings, settings['db'], log, mempool,
 				  netmagic, False, False)
+
+	# keep serving peers and RPC while workers check signatures
+	chaindb.sigverify.idle = lambda: gevent.sleep(0.001)
 	peermgr = PeerManager(log, mempool, chaindb, netmagic)
 
 	if 'loadblock' in settings:
-		chaindb.loadfile(settings['loadblock'])
+		start = None
+		if 'loadblockstart' in settings:
+			start = long(settings['loadblockstart'])
+		chaindb.loadfile(settings['loadblock'], start)
 
 	threads = []
 
@@ -490,6 +645,10 @@ if __name__ == '__main__':
 	t = gevent.Greenlet(rpcserver.serve_forever)
 	threads.append(t)
 
+	if chaindb.pipeline is not None:
+		t = gevent.Greenlet(connect_blocks, chaindb, log)
+		threads.append(t)
+
 	# connect to specified remote node
 	c = peermgr.add(settings['host'], settings['port'])
 	threads.append(c)
@@ -510,8 +669,7 @@ if __name__ == '__main__':
 			for t in threads: t.kill()
 			gevent.joinall(threads)
 			log.write('Flushing database...')
-			del chaindb.db
-			chaindb.blk_write.close()
+			chaindb.close()
 			log.write('OK')
 
 	start()
@@ -49,19 +49,14 @@ for height in xrange(chaindb.getheight()+1):
 	if height < 200000:
 		continue
 
-	heightidx = ChainDb.HeightIdx()
-	heightstr = str(height)
-	try:
-		heightidx.deserialize(chaindb.db.Get('height:'+heightstr))
-	except KeyError:
+	blkhash = chaindb.getblockhash(height)
+	if blkhash is None:
 		log.write("Height " + str(height) + " not found.")
 		continue
 
-	blkhash = heightidx.blocks[0]
-
 	block = chaindb.getblock(blkhash)
 
-	byte_size = 80 + (len(block.vtx) * 32)
+	byte_size = 80 + (block.ntx() * 32)
 	n_sizes += 1
 	size_total += byte_size
 
@@ -0,0 +1,192 @@
+#!/usr/bin/python
+#
+# repackblocks.py - rewrite block data in best chain order, dropping old
+# side chain blocks.  Run with the node stopped.
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+
+import os
+import argparse
+import leveldb
+import Log
+import MemPool
+import ChainDb
+from BlockStore import BlockStore
+from BlockIndex import BLK_HAVE_DATA, BLK_COMPRESSED
+
+from bitcoin.coredefs import NETWORKS
+from bitcoin.serialize import *
+
+BATCH_SIZE = 10000
+
+
+def segments(store):
+	# segment number -> size, of every block file present
+	r = {}
+	for fn in os.listdir(store.datadir):
+		if fn.startswith('blk') and fn.endswith('.dat'):
+			try:
+				nFile = int(fn[3:-4])
+			except ValueError:
+				continue
+			r[nFile] = os.path.getsize(os.path.join(store.datadir, fn))
+	return r
+
+def blocks_to_keep(chaindb, sidedepth):
+	# the best chain in height order, then side chain blocks no more
+	# than 'sidedepth' below the tip, parents before children
+	l = [node for node in chaindb.chain if node.status & BLK_HAVE_DATA]
+	main = set(l)
+
+	min_height = len(chaindb.chain) - sidedepth
+	side = []
+	dropped = []
+	for node in chaindb.blkindex.nodes.itervalues():
+		if not (node.status & BLK_HAVE_DATA) or node in main:
+			continue
+		if node.height >= min_height:
+			side.append(node)
+		else:
+			dropped.append(node)
+	side.sort(key=lambda node: node.height)
+
+	return (l + side, dropped)
+
+def repack(chaindb, nodes, dropped, store, log):
+	# copy each block record into the new segments.  the old ones
+	# stay until every index entry has been moved over.
+	newpos = {}
+	for node in nodes:
+		rec = chaindb.blkstore.view(node.nFile, node.pos, node.size)
+		if rec is None:
+			log.write("Block %064x: data missing, dropped" % (node.hash,))
+			dropped.append(node)
+			continue
+		newpos[node.hash] = store.write(rec)
+		if (len(newpos) % BATCH_SIZE) == 0:
+			log.write("Copied %d blocks" % (len(newpos),))
+	if store.wf is not None:
+		store.finish_file()
+	store.close()
+	log.write("Copied %d blocks" % (len(newpos),))
+
+	# the block index and write cursor change in one batch, so the
+	# node never sees a mix of old and new block positions.  each
+	# block's old position goes with it, in repack:, until its
+	# transactions' tx: entries are moved too.
+	batch = leveldb.WriteBatch()
+	for node in nodes:
+		if node.hash not in newpos:
+			continue
+		ser_hash = ser_uint256(node.hash)
+		blkpos = chaindb.node_blkpos(node)
+		batch.Put('repack:'+ser_hash, blkpos.serialize())
+		(blkpos.nFile, blkpos.pos) = newpos[node.hash]
+		batch.Put('blocks:'+ser_hash, blkpos.serialize())
+	for node in dropped:
+		batch.Delete('blocks:'+ser_uint256(node.hash))
+	batch.Put('misc:blkfile', "%d %d" % (store.nFile, store.pos))
+	chaindb.db.Write(batch, sync=True)
+
+	for node in nodes:
+		if node.hash in newpos:
+			(node.nFile, node.pos) = newpos[node.hash]
+	move_txs(chaindb, log)
+
+	return len(newpos)
+
+def move_txs(chaindb, log):
+	# point tx: entries at their blocks' new positions, from the old
+	# ones in repack:.  an entry is moved if it is still in the old
+	# segment, so this can be rerun after an interruption.
+	oldpos = {}
+	for k, v in chaindb.db.RangeIter('repack:', 'repack:' + ('\xff' * 32)):
+		blkpos = ChainDb.BlkPos()
+		blkpos.deserialize(v)
+		oldpos[uint256_from_str(k[7:])] = blkpos
+	if not oldpos:
+		return
+
+	# tx: entries move in smaller batches.  each is valid before and
+	# after its update, as both old and new segments are present.
+	batch = leveldb.WriteBatch()
+	n_batch = 0
+	n_tx = 0
+	n_bad = 0
+	txidx = ChainDb.TxIdx()
+	for k, v in chaindb.db.RangeIter('tx:', 'tx:' + ('\xff' * 32)):
+		txidx.deserialize(v)
+		old = oldpos.get(txidx.blkhash)
+		if old is None:
+			continue
+		node = chaindb.blkindex.get(txidx.blkhash)
+		if node is not None and txidx.nFile == node.nFile:
+			continue	# moved before an interruption
+		if node is None or txidx.nFile != old.nFile:
+			log.write("TX %064x: not in block %064x as recorded, left as is" % (
+				uint256_from_str(k[3:]), txidx.blkhash))
+			n_bad += 1
+			continue
+		if not (node.status & BLK_COMPRESSED):
+			# compressed blocks' offsets are within the block
+			txidx.pos = node.pos + (txidx.pos - old.pos)
+		txidx.nFile = node.nFile
+		batch.Put(k, txidx.serialize())
+		n_batch += 1
+		n_tx += 1
+		if n_batch >= BATCH_SIZE:
+			chaindb.db.Write(batch)
+			batch = leveldb.WriteBatch()
+			n_batch = 0
+	chaindb.db.Write(batch, sync=True)
+	log.write("Moved %d tx index entries, %d left as is" % (n_tx, n_bad))
+
+	batch = leveldb.WriteBatch()
+	for blkhash in oldpos:
+		batch.Delete('repack:'+ser_uint256(blkhash))
+	chaindb.db.Write(batch, sync=True)
+
+opts = argparse.ArgumentParser(description='Rewrite block data in best chain order, dropping old side chain blocks')
+opts.add_argument('datadir', help='database directory (the "db" setting)')
+opts.add_argument('--sidedepth', dest='sidedepth', type=int, default=288,
+		  help='keep side chain blocks this close to the tip (default: 288)')
+opts.add_argument('--blkfilesize', dest='blkfilesize', type=int, default=128,
+		  help='maximum segment size, in MB (default: 128)')
+opts.add_argument('--network', dest='network', default='mainnet',
+		  choices=sorted(NETWORKS.iterkeys()))
+
+args = opts.parse_args()
+
+log = Log.Log()
+
+mempool = MemPool.MemPool(log)
+chaindb = ChainDb.ChainDb({ 'txfilter' : 0 }, args.datadir, log, mempool,
+			  NETWORKS[args.network])
+
+# finish the tx: updates of an interrupted run first
+move_txs(chaindb, log)
+
+old_segments = segments(chaindb.blkstore)
+old_bytes = sum(old_segments.itervalues())
+
+(nodes, dropped) = blocks_to_keep(chaindb, args.sidedepth)
+log.write("Keeping %d blocks, dropping %d side chain blocks" % (
+	len(nodes), len(dropped)))
+
+# new segments are numbered after every existing one
+first = max(old_segments.keys() + [chaindb.blkstore.nFile]) + 1
+store = BlockStore(args.datadir, first, 0,
+		   args.blkfilesize * 1024 * 1024, 16 * 1024 * 1024)
+n_blocks = repack(chaindb, nodes, dropped, store, log)
+
+chaindb.close()
+for nFile in old_segments:
+	os.unlink(store.filename(nFile))
+
+new_bytes = sum(segments(store).itervalues())
+log.write("Repacked %d blocks into segments %d-%d: %d bytes, was %d; %d bytes recovered" % (
+	n_blocks, first, store.nFile, new_bytes, old_bytes,
+	old_bytes - new_bytes))
@@ -22,7 +22,9 @@ VALID_RPCS = {
 	"getblockcount",
 	"getblock",
 	"getblockhash",
+	"getcacheinfo",
 	"getconnectioncount",
+	"getpipelineinfo",
 	"getinfo",
 	"getrawmempool",
 	"getrawtransaction",
@@ -92,7 +94,9 @@ class RPCExec(object):
 		s += "getblock <hash> - Return block header and list of transactions\n"
 		s += "getblockcount - number of blocks in the longest block chain\n"
 		s += "getblockhash <index> - Returns hash of block in best-block-chain at <index>\n"
+		s += "getcacheinfo - block and chain state cache statistics\n"
 		s += "getconnectioncount - get P2P peer count\n"
+		s += "getpipelineinfo - block check pipeline queues and stage times\n"
 		s += "getinfo - misc. node info\n"
 		s += "getrawmempool - list mempool contents\n"
 		s += "getrawtransaction <txid> - Get serialized bytes for transaction <txid>\n"
@@ -110,6 +114,10 @@ class RPCExec(object):
 			return (None, err)
 
 		blkhash = long(params[0], 16)
+		if self.chaindb.ispruned(blkhash):
+			err = { "code" : -1, "message" : "block pruned"}
+			return (None, err)
+
 		block = self.chaindb.getblock(blkhash)
 		blkmeta = self.chaindb.getblockmeta(blkhash)
 		cur_height = self.chaindb.getheight()
@@ -130,24 +138,56 @@ class RPCExec(object):
 			not isinstance(params[0], int)):
 			return (None, err)
 
-		index = params[0]
-		heightstr = str(index)
-		if heightstr not in self.chaindb.height:
+		blkhash = self.chaindb.getblockhash(params[0])
+		if blkhash is None:
 			err = { "code" : -2, "message" : "invalid height" }
 			return (None, err)
 
-		heightidx = ChainDb.HeightIdx()
-		heightidx.deserialize(self.chaindb.height[str(index)])
+		return ("%064x" % (blkhash,), None)
 
-		return ("%064x" % (heightidx.blocks[0],), None)
+	def getcacheinfo(self, params):
+		coins = self.chaindb.coins
+		d = {}
+		d['blocks'] = self.chaindb.blk_cache.stats()
+		d['chainstate'] = {
+			'entries' : len(coins.d),
+			'bytes' : coins.bytes,
+			'dirty' : coins.n_dirty,
+			'hits' : coins.hits,
+			'misses' : coins.misses,
+			'flushes' : coins.flushes,
+		}
+		sigcache = self.chaindb.sigcache
+		d['sigcache'] = {
+			'entries' : len(sigcache.l),
+			'hits' : sigcache.hits,
+			'misses' : sigcache.misses,
+		}
+		txfilter = self.chaindb.txfilter
+		if txfilter is not None:
+			d['txfilter'] = {
+				'bytes' : len(txfilter.bits),
+				'entries' : txfilter.n_added,
+				'lookups_saved' : txfilter.n_absent,
+			}
+		return (d, None)
 
 	def getconnectioncount(self, params):
 		return (len(self.peermgr.peers), None)
 
+	def getpipelineinfo(self, params):
+		if self.chaindb.pipeline is None:
+			err = { "code" : -1, "message" : "block pipeline disabled (par=1)" }
+			return (None, err)
+		return (self.chaindb.pipeline.stats(), None)
+
 	def getinfo(self, params):
 		d = {}
 		d['protocolversion'] = bitcoin.coredefs.PROTO_VERSION
 		d['blocks'] = self.chaindb.getheight()
+		if self.chaindb.best_header is not None:
+			d['headers'] = self.chaindb.best_header.height
+		d['orphans'] = self.chaindb.orphans.stats()
 		if self.chaindb.netmagic.block0 == 0x000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26fL:
 			d['testnet'] = False
 		else:
@@ -224,6 +264,7 @@ class RPCExec(object):
 		block = self.work_blocks[block_tmp.hashMerkleRoot]
 		block.nTime = block_tmp.nTime
 		block.nNonce = block_tmp.nNonce
+		block.sha256 = None	# header changed; rehash
 
 		res = self.chaindb.putblock(block)
 
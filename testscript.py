@@ -45,7 +45,7 @@ if len(sys.argv) > 3:
 
 log = Log.Log(SETTINGS['log'])
 mempool = MemPool.MemPool(log)
-chaindb = ChainDb.ChainDb(SETTINGS['db'], log, mempool,
+chaindb = ChainDb.ChainDb(SETTINGS, SETTINGS['db'], log, mempool,
 			  NETWORKS[MY_NETWORK], True)
 chaindb.blk_cache.max = 500
 
@@ -83,15 +83,7 @@ def scan_tx(tx):
 for height in xrange(end_height):
 	if height < start_height:
 		continue
-	heightidx = ChainDb.HeightIdx()
-	heightidx.deserialize(chaindb.height[str(height)])
-
-	blkhash = heightidx.blocks[0]
-	ser_hash = ser_uint256(blkhash)
-
-	f = cStringIO.StringIO(chaindb.blocks[ser_hash])
-	block = CBlock()
-	block.deserialize(f)
+	block = chaindb.getblock(chaindb.getblockhash(height))
 
 	start_time = time.time()
 